@@ -2,82 +2,94 @@
 Pydantic модели для Architect Agent
 """
 
+import re
 from datetime import datetime
-from typing import Dict, List, Optional, Any, Union
-from enum import Enum
-from pydantic import BaseModel, Field, validator
-import uuid
+from typing import Dict, FrozenSet, List, Optional, Any, Union, Literal, get_args
+import msgspec
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, TypeAdapter, ValidationError, computed_field, field_validator, validator
+from secrets import token_hex
 
 
 # ============================================================================
-# ENUMS
+# ТИПЫ
 # ============================================================================
 
-class ComponentType(str, Enum):
-    """Типы компонентов"""
-    CLASS = "class"
-    ABSTRACT_CLASS = "abstract_class"
-    INTERFACE = "interface"
-    MODULE = "module"
-    SERVICE = "service"
-    REPOSITORY = "repository"
-    CONTROLLER = "controller"
-    MIDDLEWARE = "middleware"
-    UTILITY = "utility"
-    FACTORY = "factory"
-    SINGLETON = "singleton"
-    DECORATOR = "decorator"
-    ADAPTER = "adapter"
-    FACADE = "facade"
-    HANDLER = "handler"
-    VALIDATOR = "validator"
-    DTO = "dto"
-    ENTITY = "entity"
-    ENUM = "enum"
-    CONFIG = "config"
-    TEST = "test"
-
-
-class RelationType(str, Enum):
-    """Типы связей между компонентами"""
-    INHERITANCE = "inheritance"         # extends
-    IMPLEMENTATION = "implementation"   # implements
-    COMPOSITION = "composition"         # contains (strong)
-    AGGREGATION = "aggregation"         # has (weak)
-    DEPENDENCY = "dependency"           # uses
-    ASSOCIATION = "association"         # связан с
-
-
-class DiagramType(str, Enum):
-    """Типы диаграмм"""
-    COMPONENT = "component"
-    CLASS = "class"
-    SEQUENCE = "sequence"
-    ACTIVITY = "activity"
-    ER = "er"
-    DEPLOYMENT = "deployment"
-    USE_CASE = "use_case"
-    STATE = "state"
-
-
-class PatternCategory(str, Enum):
-    """Категории паттернов"""
-    CREATIONAL = "creational"       # Factory, Singleton, Builder
-    STRUCTURAL = "structural"        # Adapter, Facade, Decorator
-    BEHAVIORAL = "behavioral"        # Strategy, Observer, Command
-    ARCHITECTURAL = "architectural"  # MVC, MVVM, Clean Architecture
+# Типы компонентов
+ComponentType = Literal[
+    "class",
+    "abstract_class",
+    "interface",
+    "module",
+    "service",
+    "repository",
+    "controller",
+    "middleware",
+    "utility",
+    "factory",
+    "singleton",
+    "decorator",
+    "adapter",
+    "facade",
+    "handler",
+    "validator",
+    "dto",
+    "entity",
+    "enum",
+    "config",
+    "test",
+]
+
+# Типы связей между компонентами
+RelationType = Literal[
+    "inheritance",      # extends
+    "implementation",   # implements
+    "composition",      # contains (strong)
+    "aggregation",      # has (weak)
+    "dependency",       # uses
+    "association",      # связан с
+]
+
+# Типы диаграмм
+DiagramType = Literal[
+    "component",
+    "class",
+    "sequence",
+    "activity",
+    "er",
+    "deployment",
+    "use_case",
+    "state",
+]
+
+# Категории паттернов
+PatternCategory = Literal[
+    "creational",       # Factory, Singleton, Builder
+    "structural",       # Adapter, Facade, Decorator
+    "behavioral",       # Strategy, Observer, Command
+    "architectural",    # MVC, MVVM, Clean Architecture
+]
+
+# Допустимые значения для быстрой проверки строк от LLM
+COMPONENT_TYPES = frozenset(get_args(ComponentType))
+RELATION_TYPES = frozenset(get_args(RelationType))
+DIAGRAM_TYPES = frozenset(get_args(DiagramType))
+PATTERN_CATEGORIES = frozenset(get_args(PatternCategory))
 
 
 # ============================================================================
 # COMPONENT MODELS
 # ============================================================================
 
+# Модели спецификаций остаются на pydantic: они входят в response_model /process
+# и сериализуются через TypeAdapter. Из ответа LLM они собираются через
+# model_construct, так что валидация на горячем пути не выполняется.
+
 class MethodParameter(BaseModel):
     """Параметр метода"""
     name: str
     type: str
     required: bool = True
-    default: Optional[Any] = None
+    default: Any = None
     description: str = ""
 
 
@@ -93,8 +105,7 @@ class MethodSpec(BaseModel):
     is_private: bool = False
     raises: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class PropertySpec(BaseModel):
@@ -103,17 +114,16 @@ class PropertySpec(BaseModel):
     type: str
     description: str = ""
     required: bool = True
-    default: Optional[Any] = None
+    default: Any = None
     is_private: bool = False
     is_readonly: bool = False
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class ComponentSpec(BaseModel):
     """Полная спецификация компонента"""
-    id: str = Field(default_factory=lambda: str(uuid.uuid4())[:8])
+    id: str = Field(default_factory=lambda: token_hex(4))
     name: str
     type: ComponentType
     description: str = ""
@@ -133,8 +143,7 @@ class ComponentSpec(BaseModel):
     layer: str = ""  # presentation, business, data, infrastructure
     module: str = ""
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class ComponentRelation(BaseModel):
@@ -158,8 +167,7 @@ class InterfaceSpec(BaseModel):
     properties: List[PropertySpec] = Field(default_factory=list)
     extends: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -175,8 +183,7 @@ class FileSpec(BaseModel):
     imports_from: List[str] = Field(default_factory=list)  # Откуда импортирует
     exports: List[str] = Field(default_factory=list)  # Что экспортирует
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class DirectorySpec(BaseModel):
@@ -186,8 +193,7 @@ class DirectorySpec(BaseModel):
     purpose: str = ""  # Назначение директории
     files: List[FileSpec] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -203,8 +209,7 @@ class PatternRecommendation(BaseModel):
     components_affected: List[str] = Field(default_factory=list)
     example: str = ""
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -219,8 +224,7 @@ class DiagramSpec(BaseModel):
     plantuml_code: str
     svg_url: Optional[str] = None
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -235,8 +239,7 @@ class IntegrationPoint(BaseModel):
     description: str = ""
     changes_required: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class ExternalDependency(BaseModel):
@@ -246,14 +249,27 @@ class ExternalDependency(BaseModel):
     purpose: str = ""
     package_manager: str = ""  # pip, npm, cargo, etc.
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
 # ARCHITECTURE RESULT MODELS
 # ============================================================================
 
+# Слова с разбиением camelCase/PascalCase, латиница и кириллица
+_TERM_RE = re.compile(r'[A-ZА-ЯЁ]?[a-zа-яё]+|[A-ZА-ЯЁ]+(?![a-zа-яё])|\d+')
+
+
+def extract_terms(text: str) -> FrozenSet[str]:
+    """
+    Термины текста для грубого сопоставления: слова в нижнем регистре,
+    обрезанные до 6 символов (вместо стемминга), короче 3 символов отбрасываются
+    """
+    return frozenset(
+        word.lower()[:6] for word in _TERM_RE.findall(text) if len(word) >= 3
+    )
+
+
 class ExistingArchitecture(BaseModel):
     """Анализ существующей архитектуры"""
     pattern: str = "unknown"  # monolith, microservices, layered, etc.
@@ -263,8 +279,18 @@ class ExistingArchitecture(BaseModel):
     strengths: List[str] = Field(default_factory=list)
     weaknesses: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
+    
+    _component_terms: Optional[List[FrozenSet[str]]] = PrivateAttr(default=None)
+    
+    def component_terms(self) -> List[FrozenSet[str]]:
+        """Термины каждого существующего компонента для ранжирования (считаются один раз)"""
+        if self._component_terms is None:
+            self._component_terms = [
+                extract_terms(" ".join(str(v) for v in comp.values() if isinstance(v, str)))
+                for comp in self.existing_components
+            ]
+        return self._component_terms
 
 
 class ArchitectureDesign(BaseModel):
@@ -292,8 +318,7 @@ class ArchitectureDesign(BaseModel):
     recommendations: List[str] = Field(default_factory=list)
     risks: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow", defer_build=True)
 
 
 # ============================================================================
@@ -308,6 +333,44 @@ class ArchitectRequest(BaseModel):
     priority: str = "medium"
 
 
+class AnalyzeRequest(BaseModel):
+    """Запрос на анализ существующей архитектуры (/analyze)"""
+    # TechStack - msgspec.Struct, поэтому принимаем dict и конвертируем в хендлере
+    tech_stack: Dict[str, Any] = Field(default_factory=dict)
+    repo_context: Dict[str, Any] = Field(default_factory=dict)
+
+
+class DiagramRequest(BaseModel):
+    """Запрос на генерацию отдельной диаграммы (/diagram)"""
+    type: str = "component"
+    components: List[ComponentSpec] = Field(default_factory=list)
+    relations: List[ComponentRelation] = Field(default_factory=list)
+
+    @field_validator("components", "relations", mode="before")
+    @classmethod
+    def drop_invalid_items(cls, value: Any, info) -> List[Any]:
+        """
+        Невалидные элементы пропускаются, а не отклоняют весь запрос:
+        список целиком за один вызов pydantic-core, поэлементно - только если не прошёл
+        """
+        if not isinstance(value, list):
+            return []
+        if info.field_name == "components":
+            adapter, model = COMPONENT_SPECS_ADAPTER, ComponentSpec
+        else:
+            adapter, model = COMPONENT_RELATIONS_ADAPTER, ComponentRelation
+        try:
+            return adapter.validate_python(value)
+        except ValidationError:
+            valid = []
+            for item in value:
+                try:
+                    valid.append(model.model_validate(item))
+                except ValidationError:
+                    pass
+            return valid
+
+
 class ArchitectResponse(BaseModel):
     """Ответ с архитектурным дизайном"""
     task_id: str
@@ -319,38 +382,95 @@ class ArchitectResponse(BaseModel):
     # Новый дизайн
     architecture: ArchitectureDesign
     
-    # Для совместимости с другими агентами (плоская структура)
-    components: List[Dict[str, Any]] = Field(default_factory=list)
-    patterns: List[str] = Field(default_factory=list)
-    file_structure: List[Dict[str, Any]] = Field(default_factory=list)
-    interfaces: List[Dict[str, Any]] = Field(default_factory=list)
-    dependencies: List[str] = Field(default_factory=list)
-    integration_points: List[Dict[str, Any]] = Field(default_factory=list)
-    diagrams: Dict[str, str] = Field(default_factory=dict)
-    recommendations: List[str] = Field(default_factory=list)
-    
     # Метаданные
     duration_seconds: float = 0.0
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow", defer_build=True)
+    
+    # Для совместимости с другими агентами (плоская структура).
+    # Вычисляется из architecture при сериализации, отдельно не хранится.
+    
+    @computed_field
+    @property
+    def components(self) -> List[Dict[str, Any]]:
+        return [c.model_dump() for c in self.architecture.components]
+    
+    @computed_field
+    @property
+    def patterns(self) -> List[str]:
+        return [p.name for p in self.architecture.patterns]
+    
+    @computed_field
+    @property
+    def file_structure(self) -> List[Dict[str, Any]]:
+        return [f.model_dump() for f in self.architecture.file_structure]
+    
+    @computed_field
+    @property
+    def interfaces(self) -> List[Dict[str, Any]]:
+        return [i.model_dump() for i in self.architecture.interfaces]
+    
+    @computed_field
+    @property
+    def dependencies(self) -> List[str]:
+        return [d.name for d in self.architecture.external_dependencies]
+    
+    @computed_field
+    @property
+    def integration_points(self) -> List[Dict[str, Any]]:
+        return [ip.model_dump() for ip in self.architecture.integration_points]
+    
+    @computed_field
+    @property
+    def diagrams(self) -> Dict[str, str]:
+        return {d.type: d.plantuml_code for d in self.architecture.diagrams}
+    
+    @computed_field
+    @property
+    def recommendations(self) -> List[str]:
+        return self.architecture.recommendations
 
 
 # ============================================================================
 # TECH STACK (копия для совместимости)
 # ============================================================================
 
-class TechStack(BaseModel):
-    """Технологический стек проекта"""
+class TechStack(msgspec.Struct, gc=False):
+    """Технологический стек проекта (плоский msgspec.Struct со __slots__)"""
     primary_language: str = "unknown"
-    languages: List[str] = Field(default_factory=list)
-    frameworks: List[str] = Field(default_factory=list)
-    databases: List[str] = Field(default_factory=list)
-    tools: List[str] = Field(default_factory=list)
-    package_managers: List[str] = Field(default_factory=list)
-    testing_frameworks: List[str] = Field(default_factory=list)
-    ci_cd: List[str] = Field(default_factory=list)
-    architecture_patterns: List[str] = Field(default_factory=list)
-    
-    class Config:
-        extra = "allow"
\ No newline at end of file
+    languages: List[str] = msgspec.field(default_factory=list)
+    frameworks: List[str] = msgspec.field(default_factory=list)
+    databases: List[str] = msgspec.field(default_factory=list)
+    tools: List[str] = msgspec.field(default_factory=list)
+    package_managers: List[str] = msgspec.field(default_factory=list)
+    testing_frameworks: List[str] = msgspec.field(default_factory=list)
+    ci_cd: List[str] = msgspec.field(default_factory=list)
+    architecture_patterns: List[str] = msgspec.field(default_factory=list)
+    # Неизвестные поля запроса: msgspec.convert их отбрасывает, а pydantic-модель
+    # стека (extra="allow") хранила - сохраняем отдельно
+    extra: Dict[str, Any] = msgspec.field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TechStack":
+        """Создаёт стек из dict, неизвестные поля складываются в extra"""
+        if isinstance(data, dict):
+            extra = {key: value for key, value in data.items() if key not in TECH_STACK_FIELDS}
+            if extra:
+                data = {key: value for key, value in data.items() if key in TECH_STACK_FIELDS}
+                data["extra"] = extra
+        return msgspec.convert(data, cls)
+
+
+# Поля TechStack, заданные явно (extra - служебное)
+TECH_STACK_FIELDS = frozenset(TechStack.__struct_fields__) - {"extra"}
+
+
+# ============================================================================
+# TYPE ADAPTERS
+# ============================================================================
+
+# Валидаторы строятся один раз при импорте и переиспользуются между запросами
+ARCHITECT_RESPONSE_ADAPTER = TypeAdapter(ArchitectResponse)
+ARCHITECTURE_DESIGN_ADAPTER = TypeAdapter(ArchitectureDesign)
+COMPONENT_SPECS_ADAPTER = TypeAdapter(List[ComponentSpec])
+COMPONENT_RELATIONS_ADAPTER = TypeAdapter(List[ComponentRelation])
@@ -26,32 +26,39 @@ Architect Agent - Проектирует архитектуру ДО напис
 """
 
 import os
-import json
+import asyncio
+import collections
+import hashlib
+import heapq
 import logging
+import math
 import re
 import time
 import uuid
 import base64
 import zlib
-from datetime import datetime
 from typing import Dict, List, Optional, Any, Tuple
 from contextlib import asynccontextmanager
+from functools import lru_cache
 
+import msgspec
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 import httpx
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 
 from logging_config import setup_logging
 
 from models import (
-    ComponentType, RelationType, DiagramType, PatternCategory,
+    COMPONENT_TYPES, RELATION_TYPES, PATTERN_CATEGORIES,
     MethodParameter, MethodSpec, PropertySpec, ComponentSpec,
     ComponentRelation, InterfaceSpec, FileSpec, DirectorySpec,
     PatternRecommendation, DiagramSpec, IntegrationPoint, ExternalDependency,
     ExistingArchitecture, ArchitectureDesign,
-    ArchitectRequest, ArchitectResponse, TechStack
+    ArchitectRequest, ArchitectResponse, AnalyzeRequest, DiagramRequest, TechStack,
+    ARCHITECT_RESPONSE_ADAPTER, ARCHITECTURE_DESIGN_ADAPTER, extract_terms
 )
 
 # ============================================================================
@@ -61,6 +68,23 @@ from models import (
 OPENROUTER_MCP_URL = os.getenv("OPENROUTER_MCP_URL", "http://openrouter-proxy:8000")
 LLM_TIMEOUT = 1000
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL")
+BATCH_DESIGN_STEPS = os.getenv("BATCH_DESIGN_STEPS", "false").lower() == "true"
+EXISTING_ARCH_CACHE_SIZE = int(os.getenv("EXISTING_ARCH_CACHE_SIZE", "512"))
+EXISTING_ARCH_CACHE_TTL = float(os.getenv("EXISTING_ARCH_CACHE_TTL", "3600"))
+EXISTING_COMPONENTS_TOP_K = int(os.getenv("EXISTING_COMPONENTS_TOP_K", "20"))
+DIAGRAM_CACHE_SIZE = int(os.getenv("DIAGRAM_CACHE_SIZE", "1024"))
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "1.0"))
+DESIGN_COMPONENTS_MAX_TOKENS = int(os.getenv("DESIGN_COMPONENTS_MAX_TOKENS", "16000"))
+DESIGN_COMPONENTS_RETRY_MAX_TOKENS = int(os.getenv("DESIGN_COMPONENTS_RETRY_MAX_TOKENS", "64000"))
+
+# Параметры uvicorn. По умолчанию один воркер: кэши анализа и диаграмм,
+# single-flight LLM-запросов и реестр Prometheus живут в памяти процесса,
+# и при WORKERS > 1 каждый воркер держит свои (а /metrics отдаёт метрики
+# только того воркера, который ответил)
+WORKERS = int(os.getenv("WORKERS", "1"))
+LIMIT_CONCURRENCY = int(os.getenv("LIMIT_CONCURRENCY", "200"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+TIMEOUT_KEEP_ALIVE = int(os.getenv("TIMEOUT_KEEP_ALIVE", "5"))
 
 logger = setup_logging("architect")
 
@@ -78,12 +102,8 @@ AGENT_ACTIVE_REQUESTS = Gauge('agent_active_requests', 'Number of active request
 PM_AGENT_STATUS = Gauge('pm_agent_status', 'Agent status', ['agent_name'])
 PM_SYSTEM_ERRORS_TOTAL = Counter('pm_system_errors_total', 'Total system errors', ['agent_name', 'error_type'])
 
-# Стандартизированные метрики для всех агентов
-PM_AGENT_CALLS = Counter('pm_agent_calls_total', 'Agent calls', ['agent_name', 'status'])
-PM_AGENT_RESPONSE_TIME_SECONDS_BUCKET = Histogram('pm_agent_response_time_seconds_bucket', 'Agent response time', ['agent_name'], buckets=[0.5, 1, 2, 5, 10, 30, 60, 120, 300])
-PM_ACTIVE_TASKS = Gauge('pm_active_tasks', 'Currently processing tasks', ['method', 'endpoint'])
-PM_TASKS_TOTAL = Counter('pm_tasks_total', 'Total tasks processed', ['status', 'method', 'endpoint'])
-PM_TASK_DURATION = Histogram('pm_task_duration_seconds_bucket', 'Task duration', buckets=[30, 60, 120, 300, 600, 1200])
+# Представления pm_* по запросам архитектора строятся из agent_* метрик
+# recording rules в monitoring/rules/architect.yml
 
 # ============================================================================
 # HTTP CLIENT
@@ -96,7 +116,11 @@ http_client: Optional[httpx.AsyncClient] = None
 async def lifespan(app: FastAPI):
     """Lifecycle manager"""
     global http_client
-    http_client = httpx.AsyncClient(timeout=httpx.Timeout(LLM_TIMEOUT))
+    http_client = httpx.AsyncClient(
+        base_url=OPENROUTER_MCP_URL,
+        timeout=httpx.Timeout(LLM_TIMEOUT),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+    )
     
     # Устанавливаем статус агента при запуске
     PM_AGENT_STATUS.labels(agent_name="architect").set(1)  # 1 = online
@@ -119,7 +143,8 @@ app = FastAPI(
     title="Architect Agent",
     description="Агент для проектирования архитектуры ПО",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 
@@ -127,17 +152,32 @@ app = FastAPI(
 # PROMETHEUS MIDDLEWARE
 # ============================================================================
 
+@lru_cache(maxsize=256)
+def bind_request_metrics(method: str, endpoint: str) -> Tuple[Gauge, Histogram]:
+    """Дочерние метрики, привязанные к (method, endpoint)"""
+    return (
+        AGENT_ACTIVE_REQUESTS.labels(method=method, endpoint=endpoint),
+        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method=method, endpoint=endpoint)
+    )
+
+
+@lru_cache(maxsize=256)
+def bind_requests_total(method: str, endpoint: str, status: str) -> Counter:
+    """Счётчик запросов, привязанный к (method, endpoint, status)"""
+    return AGENT_REQUESTS_TOTAL.labels(method=method, endpoint=endpoint, status=status)
+
+
 @app.middleware("http")
 async def prometheus_middleware(request: Request, call_next):
     """Middleware для отслеживания HTTP метрик"""
     # Исключаем эндпоинты /health и /metrics из метрик
-    if request.url.path in ["/health", "/metrics"]:
+    path = request.url.path
+    if path in ("/health", "/metrics"):
         return await call_next(request)
     
-    agent_name = "architect_agent"
-    AGENT_ACTIVE_REQUESTS.labels(method=request.method, endpoint=request.url.path).inc()
-    PM_ACTIVE_TASKS.labels(method=request.method, endpoint=request.url.path).inc()
-    start_time = time.time()
+    active, response_time = bind_request_metrics(request.method, path)
+    active.inc()
+    start_time = time.perf_counter()
     try:
         response = await call_next(request)
         status = str(response.status_code)
@@ -145,37 +185,19 @@ async def prometheus_middleware(request: Request, call_next):
         status = "500"
         raise
     else:
-        duration = time.time() - start_time
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method=request.method, endpoint=request.url.path).observe(duration)
-        AGENT_REQUESTS_TOTAL.labels(method=request.method, endpoint=request.url.path, status=status).inc()
-        
-        # Обновляем стандартизированные метрики
-        PM_AGENT_CALLS.labels(agent_name=agent_name, status=status).inc()
-        PM_AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(agent_name=agent_name).observe(duration)
-        PM_TASKS_TOTAL.labels(status=status, method=request.method, endpoint=request.url.path).inc()
-        PM_TASK_DURATION.observe(duration)
-        
+        duration = time.perf_counter() - start_time
+        response_time.observe(duration)
+        bind_requests_total(request.method, path, status).inc()
         return response
     finally:
-        AGENT_ACTIVE_REQUESTS.labels(method=request.method, endpoint=request.url.path).dec()
-        PM_ACTIVE_TASKS.labels(method=request.method, endpoint=request.url.path).dec()
+        active.dec()
 
 
 # ============================================================================
 # LLM HELPER
 # ============================================================================
 
-async def call_llm(
-    prompt: str,
-    system_prompt: Optional[str] = None,
-    temperature: float = 0.3,
-    max_tokens: int = 100000,
-    step_name: str = "llm_request"
-) -> str:
-    """Вызов LLM через OpenRouter MCP"""
-
-    if not system_prompt:
-        system_prompt = """Ты опытный архитектор ПО с 20+ лет опыта проектирования систем.
+DEFAULT_SYSTEM_PROMPT = """Ты опытный архитектор ПО с 20+ лет опыта проектирования систем.
 Ты отлично знаешь:
 - Паттерны проектирования (GoF, Enterprise, DDD)
 - Архитектурные стили (Clean Architecture, Hexagonal, Microservices)
@@ -190,11 +212,82 @@ async def call_llm(
 
 Всегда учитываешь существующий код и стиль проекта.
 Возвращаешь ответы в JSON когда это указано."""
+DEFAULT_SYSTEM_MESSAGE = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
+
+
+# Одинаковые запросы к LLM, выполняющиеся прямо сейчас (single-flight)
+llm_inflight: Dict[str, asyncio.Task] = {}
+
+
+def release_inflight(key: str, task: asyncio.Task) -> None:
+    """Убирает завершившийся запрос из llm_inflight"""
+    if llm_inflight.get(key) is task:
+        del llm_inflight[key]
+    # Если все ожидающие отменены, ошибку некому забрать - забираем сами,
+    # чтобы asyncio не писал "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+async def call_llm(
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    temperature: float = 0.3,
+    max_tokens: int = 100000,
+    step_name: str = "llm_request",
+    prefix: Optional[str] = None
+) -> str:
+    """
+    Вызов LLM с объединением одновременных одинаковых запросов:
+    первый вызов запускает запрос в OpenRouter MCP отдельной задачей,
+    остальные ждут её результат.
+    prefix - общий для нескольких шагов контекст, отправляется первым
+    блоком сообщения и помечается для кэширования у провайдера
+    """
+    key = hashlib.sha256(
+        "\x00".join((prefix or "", prompt, system_prompt or "", str(temperature), str(max_tokens), step_name)).encode()
+    ).hexdigest()
+    
+    task = llm_inflight.get(key)
+    if task is not None:
+        logger.info(f"step: {step_name} (joined in-flight request)")
+    else:
+        # Запрос не привязан к задаче первого вызвавшего: если его клиент
+        # отключится, остальные всё равно получат результат
+        task = asyncio.create_task(request_llm(prompt, system_prompt, temperature, max_tokens, step_name, prefix))
+        llm_inflight[key] = task
+        task.add_done_callback(lambda done: release_inflight(key, done))
+    
+    # shield: отмена ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+
+async def request_llm(
+    prompt: str,
+    system_prompt: Optional[str],
+    temperature: float,
+    max_tokens: int,
+    step_name: str,
+    prefix: Optional[str] = None
+) -> str:
+    """Вызов LLM через OpenRouter MCP"""
 
     # Подготовка сообщений для запроса
+    if system_prompt:
+        system_message = {"role": "system", "content": system_prompt}
+    else:
+        system_message = DEFAULT_SYSTEM_MESSAGE
+    if prefix:
+        # Одинаковый префикс у разных шагов провайдер берёт из кэша промптов
+        user_content = [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": prompt}
+        ]
+    else:
+        user_content = prompt
     messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": prompt}
+        system_message,
+        {"role": "user", "content": user_content}
     ]
 
     # Логирование начала запроса - только шаг
@@ -206,37 +299,35 @@ async def call_llm(
         # Метрики запросов к LLM теперь отслеживаются в OpenRouter MCP
         
         response = await http_client.post(
-            f"{OPENROUTER_MCP_URL}/chat/completions",
-            json={
+            "/chat/completions",
+            content=orjson.dumps({
                 "model": DEFAULT_MODEL,
                 "messages": messages,
                 "temperature": temperature,
                 "max_tokens": max_tokens
-            },
+            }),
+            headers={"content-type": "application/json"},
             timeout=LLM_TIMEOUT
         )
 
-        duration = time.time() - start_time
+        finished_at = time.time()
+        duration = finished_at - start_time
 
         if response.status_code == 200:
             response_data = response.json()
-            content = response_data["choices"][0]["message"]["content"]
+            message = response_data["choices"][0]["message"]
+            content = message["content"]
+            # Извлечение reasoning (если присутствует)
+            reasoning = message.get("reasoning", message.get("reasoning_content"))
 
             # Извлечение информации о токенах
-            usage = response_data.get("usage", {})
+            usage = response_data.get("usage") or {}
             prompt_tokens = usage.get("prompt_tokens", 0)
             completion_tokens = usage.get("completion_tokens", 0)
             total_tokens = usage.get("total_tokens", 0)
 
             # Метрики токенов теперь отслеживаются в OpenRouter MCP
 
-            # Извлечение reasoning (если присутствует)
-            reasoning = None
-            if "reasoning" in response_data["choices"][0]["message"]:
-                reasoning = response_data["choices"][0]["message"]["reasoning"]
-            elif "reasoning_content" in response_data["choices"][0]["message"]:
-                reasoning = response_data["choices"][0]["message"]["reasoning_content"]
-
             # Логирование успешного ответа - полностью логируем ответы и reasoning
             response_log = {
                 "event": "llm_request_success",
@@ -247,9 +338,9 @@ async def call_llm(
                 "total_tokens": total_tokens,
                 "content": content,
                 "reasoning": reasoning,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": finished_at
             }
-            logger.info(json.dumps(response_log, ensure_ascii=False))
+            logger.info(orjson.dumps(response_log).decode())
 
             return content
         else:
@@ -260,9 +351,9 @@ async def call_llm(
                 "duration_seconds": round(duration, 3),
                 "status_code": response.status_code,
                 "error_response": response.text,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": finished_at
             }
-            logger.error(json.dumps(error_log, ensure_ascii=False))
+            logger.error(orjson.dumps(error_log).decode())
             
             # Обновляем метрику системных ошибок
             PM_SYSTEM_ERRORS_TOTAL.labels(agent_name="architect", error_type="llm_error").inc()
@@ -270,7 +361,8 @@ async def call_llm(
             return ""
 
     except Exception as e:
-        duration = time.time() - start_time
+        finished_at = time.time()
+        duration = finished_at - start_time
         
         # Логирование исключения и обновление метрики
         exception_log = {
@@ -278,50 +370,93 @@ async def call_llm(
             "model": DEFAULT_MODEL,
             "duration_seconds": round(duration, 3),
             "exception": str(e),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": finished_at
         }
-        logger.error(json.dumps(exception_log, ensure_ascii=False))
+        logger.error(orjson.dumps(exception_log).decode())
         
         # Обновляем метрику системных ошибок
         PM_SYSTEM_ERRORS_TOTAL.labels(agent_name="architect", error_type="exception").inc()
         
         return ""
 
+
+_MD_JSON_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+
+
+def dumps_json(data: Any) -> str:
+    """Сериализует данные для вставки в промпт: компактный JSON без отступов и без экранирования не-ASCII"""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
 def parse_json_response(response: str) -> Optional[Dict]:
     """Извлекает JSON из ответа LLM"""
     try:
-        return json.loads(response)
-    except json.JSONDecodeError:
+        return orjson.loads(response)
+    except orjson.JSONDecodeError:
         pass
     
     try:
-        # Ищем JSON в markdown блоке
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group(1))
+        # Ищем JSON в markdown блоке (regex запускаем только при наличии ```)
+        if response.find('```') != -1:
+            json_match = _MD_JSON_RE.search(response)
+            if json_match:
+                return orjson.loads(json_match.group(1))
         
-        # Ищем JSON объект
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group())
-    except json.JSONDecodeError as e:
+        # Ищем JSON объект: от первой "{" до последней "}"
+        start = response.find('{')
+        end = response.rfind('}')
+        if start != -1 and end > start:
+            return orjson.loads(response[start:end + 1])
+    except orjson.JSONDecodeError as e:
         logger.error(f"JSON parse error: {e}")
     
     return None
 
 
+# Значения из ответа LLM неверного типа заменяются значениями по умолчанию:
+# модели после этого собираются через model_construct без валидации
+
+def as_str(value: Any, default: str = "") -> str:
+    """Строка из ответа LLM, иначе default"""
+    return value if isinstance(value, str) else default
+
+
+def as_bool(value: Any, default: bool = False) -> bool:
+    """Булево значение из ответа LLM, иначе default ("yes" и 1 не считаются)"""
+    return value if isinstance(value, bool) else default
+
+
+def as_str_list(value: Any) -> List[str]:
+    """Список строк из ответа LLM: нестроковые элементы отбрасываются"""
+    if not isinstance(value, list):
+        return []
+    return [item for item in value if isinstance(item, str)]
+
+
+def as_dict_list(value: Any) -> List[Dict[str, Any]]:
+    """Список объектов из ответа LLM: всё, что не словарь, отбрасывается"""
+    if not isinstance(value, list):
+        return []
+    return [item for item in value if isinstance(item, dict)]
+
+
 # ============================================================================
 # PLANTUML HELPERS
 # ============================================================================
 
+# Raw deflate (без zlib заголовка и adler32), копируется на каждый вызов
+_PLANTUML_COMPRESSOR = zlib.compressobj(level=6, wbits=-15)
+_PLANTUML_TRANS = bytes.maketrans(b'+/', b'-_')
+
+
 def generate_plantuml_url(plantuml_code: str) -> str:
     """Генерирует URL для PlantUML диаграммы"""
     try:
         plantuml_code = plantuml_code.strip()
         utf8_bytes = plantuml_code.encode('utf-8')
-        compressed = zlib.compress(utf8_bytes, 9)[2:-4]
-        encoded = base64.b64encode(compressed).decode('ascii')
-        encoded = encoded.translate(str.maketrans({'+': '-', '/': '_'}))
+        compressor = _PLANTUML_COMPRESSOR.copy()
+        compressed = compressor.compress(utf8_bytes) + compressor.flush()
+        encoded = base64.b64encode(compressed).translate(_PLANTUML_TRANS).decode('ascii')
         return f"http://www.plantuml.com/plantuml/svg/{encoded}"
     except Exception as e:
         logger.error(f"PlantUML URL generation error: {e}")
@@ -332,24 +467,68 @@ def generate_plantuml_url(plantuml_code: str) -> str:
 # EXISTING ARCHITECTURE ANALYSIS
 # ============================================================================
 
+# Результаты анализа по отпечатку repo_context + tech_stack: key -> (expires_at, result)
+existing_arch_cache: "collections.OrderedDict[str, Tuple[float, ExistingArchitecture]]" = collections.OrderedDict()
+
+
+def existing_arch_cache_key(repo_context: Dict[str, Any], tech_stack: TechStack) -> str:
+    """
+    Отпечаток входных данных анализа существующей архитектуры
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(orjson.dumps(repo_context, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS))
+    digest.update(b"\x00")
+    digest.update(msgspec.json.encode(tech_stack))
+    return digest.hexdigest()
+
+
+def dump_json_prefix(data: Dict[str, Any], limit: int) -> str:
+    """
+    Возвращает первые limit символов dumps_json(data), сериализуя
+    элементы словаря по одному и останавливаясь, как только набран
+    нужный объём
+    """
+    parts = []
+    size = 0  # "{" минус разделитель перед первым элементом
+    for key, value in data.items():
+        # Элемент как словарь из одной пары: ключи сериализуются так же, как в dumps_json
+        part = dumps_json({key: value})[1:-1]
+        parts.append(part)
+        size += len(part) + 1  # разделитель ","
+        if size >= limit:
+            break
+    return ("{" + ",".join(parts) + "}")[:limit]
+
+
 async def analyze_existing_architecture(
     repo_context: Dict[str, Any],
     tech_stack: TechStack
 ) -> ExistingArchitecture:
     """
-    Анализирует существующую архитектуру репозитория
+    Анализирует существующую архитектуру репозитория.
+    Результат кэшируется по отпечатку входных данных на EXISTING_ARCH_CACHE_TTL секунд
     """
     
+    cache_key = existing_arch_cache_key(repo_context, tech_stack)
+    cached = existing_arch_cache.get(cache_key)
+    if cached is not None:
+        expires_at, result = cached
+        if expires_at > time.monotonic():
+            existing_arch_cache.move_to_end(cache_key)
+            logger.info("step: analyze_existing_architecture (cache hit)")
+            return result
+        del existing_arch_cache[cache_key]
+    
     structure = repo_context.get("structure", [])
     key_files = repo_context.get("key_files", {})
     
     # Группируем файлы по директориям
-    directories = {}
-    for item in structure:
-        path = item.get("path", "")
-        if "/" in path:
-            dir_path = path.rsplit("/", 1)[0]
-            directories[dir_path] = directories.get(dir_path, 0) + 1
+    directories = collections.Counter(
+        path.rsplit("/", 1)[0]
+        for item in structure
+        if "/" in (path := item.get("path", ""))
+    )
+    top_directories = dict(heapq.nlargest(30, directories.items(), key=lambda kv: kv[1]))
     
     prompt = f"""
 Проанализируй существующую архитектуру проекта.
@@ -360,13 +539,13 @@ async def analyze_existing_architecture(
 - Паттерны: {', '.join(tech_stack.architecture_patterns)}
 
 ## СТРУКТУРА ДИРЕКТОРИЙ:
-{json.dumps(dict(sorted(directories.items(), key=lambda x: -x[1])[:30]), indent=2)}
+{dumps_json(top_directories)}
 
 ## КЛЮЧЕВЫЕ ФАЙЛЫ:
-{json.dumps(list(key_files.keys())[:40], indent=2)}
+{dumps_json(list(key_files.keys())[:40])}
 
 ## СОДЕРЖИМОЕ КЛЮЧЕВЫХ ФАЙЛОВ:
-{json.dumps(key_files, indent=2, ensure_ascii=False)[:150000]}
+{dump_json_prefix(key_files, 150000)}
 
 ## ОПРЕДЕЛИ:
 
@@ -403,14 +582,26 @@ async def analyze_existing_architecture(
     parsed = parse_json_response(response)
 
     if parsed:
-        return ExistingArchitecture(
-            pattern=parsed.get("pattern", "unknown"),
-            layers=parsed.get("layers", []),
-            existing_components=parsed.get("existing_components", []),
-            conventions=parsed.get("conventions", {}),
-            strengths=parsed.get("strengths", []),
-            weaknesses=parsed.get("weaknesses", [])
+        # Типы полей приводим сами, без повторной валидации pydantic.
+        # Результат попадает в кэш, поэтому неверные значения (например,
+        # компоненты строками) отбрасываем, а не пропускаем дальше
+        conventions = parsed.get("conventions")
+        result = ExistingArchitecture.model_construct(
+            pattern=as_str(parsed.get("pattern"), "unknown"),
+            layers=as_str_list(parsed.get("layers")),
+            existing_components=as_dict_list(parsed.get("existing_components")),
+            conventions=(
+                {key: value for key, value in conventions.items() if isinstance(value, str)}
+                if isinstance(conventions, dict) else {}
+            ),
+            strengths=as_str_list(parsed.get("strengths")),
+            weaknesses=as_str_list(parsed.get("weaknesses"))
         )
+        # Кэшируем только успешный разбор, чтобы сбой LLM не закреплялся на час
+        existing_arch_cache[cache_key] = (time.monotonic() + EXISTING_ARCH_CACHE_TTL, result)
+        if len(existing_arch_cache) > EXISTING_ARCH_CACHE_SIZE:
+            existing_arch_cache.popitem(last=False)
+        return result
 
     return ExistingArchitecture()
 
@@ -421,9 +612,7 @@ async def analyze_existing_architecture(
 
 async def design_components(
     task: str,
-    existing_arch: ExistingArchitecture,
-    tech_stack: TechStack,
-    repo_context: Dict[str, Any]
+    shared_prefix: str
 ) -> Tuple[List[ComponentSpec], List[InterfaceSpec], List[ComponentRelation]]:
     """
     Проектирует новые компоненты для выполнения задачи
@@ -435,19 +624,6 @@ async def design_components(
 ## ЗАДАЧА:
 {task}
 
-## СУЩЕСТВУЮЩАЯ АРХИТЕКТУРА:
-- Паттерн: {existing_arch.pattern}
-- Слои: {', '.join(existing_arch.layers)}
-- Соглашения: {json.dumps(existing_arch.conventions, ensure_ascii=False)}
-
-## СУЩЕСТВУЮЩИЕ КОМПОНЕНТЫ:
-{json.dumps(existing_arch.existing_components[:50], indent=2, ensure_ascii=False)}
-
-## ТЕХНОЛОГИИ:
-- Язык: {tech_stack.primary_language}
-- Фреймворки: {', '.join(tech_stack.frameworks)}
-- Тестирование: {', '.join(tech_stack.testing_frameworks)}
-
 ## ТРЕБОВАНИЯ:
 1. Следуй существующей архитектуре и соглашениям
 2. Проектируй по SOLID принципам
@@ -545,152 +721,153 @@ async def design_components(
 }}
 """
     
-    response = await call_llm(prompt, max_tokens=100000, step_name="design_components")
+    response = await call_llm(
+        prompt, max_tokens=DESIGN_COMPONENTS_MAX_TOKENS, step_name="design_components", prefix=shared_prefix
+    )
     parsed = parse_json_response(response)
 
-    components = []
-    interfaces = []
-    relations = []
+    if not parsed and response:
+        # Непарсящийся ответ чаще всего обрезан по max_tokens - повторяем с запасом
+        logger.warning("design_components: unparsable response, retrying with larger max_tokens")
+        response = await call_llm(
+            prompt, max_tokens=DESIGN_COMPONENTS_RETRY_MAX_TOKENS, step_name="design_components", prefix=shared_prefix
+        )
+        parsed = parse_json_response(response)
 
-    if parsed:
-        # Парсим компоненты
-        for comp_data in parsed.get("components", []):
-            try:
-                comp_type = ComponentType(comp_data.get("type", "class"))
-            except ValueError:
-                comp_type = ComponentType.CLASS
-
-            properties = []
-            for prop in comp_data.get("properties", []):
-                properties.append(PropertySpec(**prop))
-
-            methods = []
-            for method in comp_data.get("methods", []):
-                params = []
-                for p in method.get("parameters", []):
-                    # Handle default values that might be lists
-                    default_val = p.get("default")
-                    if isinstance(default_val, list):
-                        # Convert list to string representation for storage
-                        default_val = str(default_val)
-                    params.append(MethodParameter(**{**p, "default": default_val}))
-                methods.append(MethodSpec(
-                    name=method.get("name", ""),
-                    description=method.get("description", ""),
-                    parameters=params,
-                    return_type=method.get("return_type", "None"),
-                    is_async=method.get("is_async", False),
-                    is_static=method.get("is_static", False),
-                    raises=method.get("raises", [])
-                ))
-
-            # ИСПРАВЛЕНИЕ: Гарантируем, что implements и dependencies - списки
-            implements = comp_data.get("implements")
-            if implements is None or not isinstance(implements, list):
-                implements = []
-                
-            dependencies = comp_data.get("dependencies")
-            if dependencies is None or not isinstance(dependencies, list):
-                dependencies = []
-            
-            # ИСПРАВЛЕНИЕ: Гарантируем, что extends - строка или None
-            extends = comp_data.get("extends")
-            if extends is not None and not isinstance(extends, str):
-                extends = None
-
-            components.append(ComponentSpec(
-                name=comp_data.get("name", ""),
-                type=comp_type,
-                description=comp_data.get("description", ""),
-                responsibility=comp_data.get("responsibility", ""),
-                properties=properties,
-                methods=methods,
-                dependencies=dependencies,
-                extends=extends,
-                implements=implements,
-                layer=comp_data.get("layer", "")
-            ))
-
-            # Парсим интерфейсы
-            for iface_data in parsed.get("interfaces", []):
-                methods = []
-                for method in iface_data.get("methods", []):
-                    params = []
-                    for p in method.get("parameters", []):
-                        # ИСПРАВЛЕНИЕ: То же для параметров методов
-                        if isinstance(p, dict):
-                            params.append(MethodParameter(**p))
-                        else:
-                            logger.warning(f"Invalid parameter format: {p}")
-                            continue
-                    
-                    methods.append(MethodSpec(
-                        name=method.get("name", ""),
-                        parameters=params,
-                        return_type=method.get("return_type", "None")
-                    ))
-
-                interfaces.append(InterfaceSpec(
-                    name=iface_data.get("name", ""),
-                    description=iface_data.get("description", ""),
-                    methods=methods
-                ))
-
-            # Парсим связи
-            for rel_data in parsed.get("relations", []):
-                try:
-                    rel_type = RelationType(rel_data.get("relation_type", "dependency"))
-                except ValueError:
-                    rel_type = RelationType.DEPENDENCY
-
-                relations.append(ComponentRelation(
-                    source=rel_data.get("source", ""),
-                    target=rel_data.get("target", ""),
-                    relation_type=rel_type,
-                    description=rel_data.get("description", "")
-                ))
+    if not parsed:
+        return [], [], []
+
+    components = [parse_component(comp_data) for comp_data in as_dict_list(parsed.get("components"))]
+    interfaces = [
+        InterfaceSpec.model_construct(
+            name=as_str(iface_data.get("name")),
+            description=as_str(iface_data.get("description")),
+            methods=[parse_method(method) for method in as_dict_list(iface_data.get("methods"))]
+        )
+        for iface_data in as_dict_list(parsed.get("interfaces"))
+    ]
+    relations = [parse_relation(rel_data) for rel_data in as_dict_list(parsed.get("relations"))]
 
     return components, interfaces, relations
 
 
+# Поля нормализуются вручную (as_str/as_bool/as_str_list), поэтому модели
+# собираем через model_construct без повторной валидации pydantic
+
+def parse_parameters(raw_params: Any) -> List[MethodParameter]:
+    """Параметры метода из ответа LLM"""
+    if not isinstance(raw_params, list):
+        return []
+    params = [p for p in raw_params if isinstance(p, dict)]
+    if len(params) != len(raw_params):
+        logger.warning(f"Invalid parameter format: {[p for p in raw_params if not isinstance(p, dict)]}")
+    
+    return [
+        MethodParameter.model_construct(
+            name=as_str(p.get("name")),
+            type=as_str(p.get("type"), "Any"),
+            required=as_bool(p.get("required"), True),
+            # Списки в default храним строкой
+            default=str(p["default"]) if isinstance(p.get("default"), list) else p.get("default"),
+            description=as_str(p.get("description"))
+        )
+        for p in params
+    ]
+
+
+def parse_method(method: Dict[str, Any]) -> MethodSpec:
+    """Метод компонента или интерфейса из ответа LLM"""
+    return MethodSpec.model_construct(
+        name=as_str(method.get("name")),
+        description=as_str(method.get("description")),
+        parameters=parse_parameters(method.get("parameters")),
+        return_type=as_str(method.get("return_type"), "None"),
+        is_async=as_bool(method.get("is_async")),
+        is_static=as_bool(method.get("is_static")),
+        raises=as_str_list(method.get("raises"))
+    )
+
+
+def parse_property(prop: Dict[str, Any]) -> PropertySpec:
+    """Свойство компонента из ответа LLM (лишние ключи сохраняются - extra="allow")"""
+    return PropertySpec.model_construct(**{
+        **prop,
+        "name": as_str(prop.get("name")),
+        "type": as_str(prop.get("type"), "Any"),
+        "description": as_str(prop.get("description")),
+        "required": as_bool(prop.get("required"), True),
+        "is_private": as_bool(prop.get("is_private")),
+        "is_readonly": as_bool(prop.get("is_readonly"))
+    })
+
+
+def parse_component(comp_data: Dict[str, Any]) -> ComponentSpec:
+    """Компонент из ответа LLM"""
+    # Значения неверного типа заменяем значениями по умолчанию, а не отбрасываем компонент;
+    # type - из COMPONENT_TYPES, extends - строка или None
+    comp_type = comp_data.get("type")
+    extends = comp_data.get("extends")
+
+    return ComponentSpec.model_construct(
+        name=as_str(comp_data.get("name")),
+        type=comp_type if isinstance(comp_type, str) and comp_type in COMPONENT_TYPES else "class",
+        description=as_str(comp_data.get("description")),
+        responsibility=as_str(comp_data.get("responsibility")),
+        properties=[parse_property(prop) for prop in as_dict_list(comp_data.get("properties"))],
+        methods=[parse_method(method) for method in as_dict_list(comp_data.get("methods"))],
+        dependencies=as_str_list(comp_data.get("dependencies")),
+        extends=extends if isinstance(extends, str) else None,
+        implements=as_str_list(comp_data.get("implements")),
+        layer=as_str(comp_data.get("layer"))
+    )
+
+
+def parse_relation(rel_data: Dict[str, Any]) -> ComponentRelation:
+    """Связь между компонентами из ответа LLM"""
+    rel_type = rel_data.get("relation_type", "dependency")
+    # list/dict в frozenset не ищутся (unhashable) - проверяем тип заранее
+    if not (isinstance(rel_type, str) and rel_type in RELATION_TYPES):
+        rel_type = "dependency"
+
+    return ComponentRelation.model_construct(
+        source=as_str(rel_data.get("source")),
+        target=as_str(rel_data.get("target")),
+        relation_type=rel_type,
+        description=as_str(rel_data.get("description"))
+    )
+
+
+def build_components_info(components: List[ComponentSpec]) -> List[Dict[str, Any]]:
+    """Краткое описание компонентов для промптов последующих шагов"""
+    return [
+        {"name": c.name, "type": c.type, "layer": c.layer, "responsibility": c.responsibility}
+        for c in components
+    ]
+
+
 # ============================================================================
 # FILE STRUCTURE PLANNING
 # ============================================================================
 
 async def plan_file_structure(
-    components: List[ComponentSpec],
+    components_info: List[Dict[str, Any]],
     interfaces: List[InterfaceSpec],
-    existing_arch: ExistingArchitecture,
-    tech_stack: TechStack
+    shared_prefix: str
 ) -> List[FileSpec]:
     """
     Планирует структуру файлов для компонентов
     """
     
-    components_info = [
-        {"name": c.name, "type": c.type.value, "layer": c.layer}
-        for c in components
-    ]
-    
     interfaces_info = [{"name": i.name} for i in interfaces]
     
     prompt = f"""
 Спланируй структуру файлов для новых компонентов.
 
 ## КОМПОНЕНТЫ:
-{json.dumps(components_info, indent=2)}
+{dumps_json(components_info)}
 
 ## ИНТЕРФЕЙСЫ:
-{json.dumps(interfaces_info, indent=2)}
-
-## СУЩЕСТВУЮЩАЯ СТРУКТУРА:
-- Паттерн: {existing_arch.pattern}
-- Слои: {', '.join(existing_arch.layers)}
-- Соглашения: {json.dumps(existing_arch.conventions, ensure_ascii=False)}
-
-## ТЕХНОЛОГИИ:
-- Язык: {tech_stack.primary_language}
-- Фреймворки: {', '.join(tech_stack.frameworks)}
+{dumps_json(interfaces_info)}
 
 ## ТРЕБОВАНИЯ:
 1. Следуй существующим соглашениям по именованию
@@ -733,23 +910,25 @@ async def plan_file_structure(
 }}
 """
     
-    response = await call_llm(prompt, step_name="plan_file_structure")
+    response = await call_llm(prompt, step_name="plan_file_structure", prefix=shared_prefix)
     parsed = parse_json_response(response)
 
-    files = []
+    return parse_file_structure(parsed) if parsed else []
 
-    if parsed:
-        for file_data in parsed.get("files", []):
-            files.append(FileSpec(
-                path=file_data.get("path", ""),
-                type=file_data.get("type", "module"),
-                description=file_data.get("description", ""),
-                contains=file_data.get("contains", []),
-                imports_from=file_data.get("imports_from", []),
-                exports=file_data.get("exports", [])
-            ))
 
-    return files
+def parse_file_structure(parsed: Dict[str, Any]) -> List[FileSpec]:
+    """Структура файлов из ответа LLM"""
+    return [
+        FileSpec(
+            path=file_data.get("path", ""),
+            type=file_data.get("type", "module"),
+            description=file_data.get("description", ""),
+            contains=file_data.get("contains", []),
+            imports_from=file_data.get("imports_from", []),
+            exports=file_data.get("exports", [])
+        )
+        for file_data in parsed.get("files", [])
+    ]
 
 
 # ============================================================================
@@ -758,18 +937,13 @@ async def plan_file_structure(
 
 async def select_patterns(
     task: str,
-    components: List[ComponentSpec],
-    tech_stack: TechStack
+    components_info: List[Dict[str, Any]],
+    shared_prefix: str
 ) -> List[PatternRecommendation]:
     """
     Выбирает подходящие паттерны проектирования
     """
     
-    components_info = [
-        {"name": c.name, "type": c.type.value, "responsibility": c.responsibility}
-        for c in components
-    ]
-    
     prompt = f"""
 Рекомендуй паттерны проектирования для задачи.
 
@@ -777,10 +951,7 @@ async def select_patterns(
 {task}
 
 ## КОМПОНЕНТЫ:
-{json.dumps(components_info, indent=2, ensure_ascii=False)}
-
-## ТЕХНОЛОГИИ:
-{tech_stack.primary_language}, {', '.join(tech_stack.frameworks)}
+{dumps_json(components_info)}
 
 ## РАССМОТРИ ПАТТЕРНЫ:
 
@@ -811,28 +982,29 @@ async def select_patterns(
 }}
 """
     
-    response = await call_llm(prompt, step_name="select_patterns")
+    response = await call_llm(prompt, step_name="select_patterns", prefix=shared_prefix)
     parsed = parse_json_response(response)
 
-    patterns = []
-
-    if parsed:
-        for pattern_data in parsed.get("patterns", []):
-            try:
-                category = PatternCategory(pattern_data.get("category", "behavioral"))
-            except ValueError:
-                category = PatternCategory.BEHAVIORAL
-
-            patterns.append(PatternRecommendation(
-                name=pattern_data.get("name", ""),
-                category=category,
-                reason=pattern_data.get("reason", ""),
-                how_to_apply=pattern_data.get("how_to_apply", ""),
-                components_affected=pattern_data.get("components_affected", []),
-                example=pattern_data.get("example", "")
-            ))
-
-    return patterns
+    return parse_patterns(parsed) if parsed else []
+
+
+def parse_patterns(parsed: Dict[str, Any]) -> List[PatternRecommendation]:
+    """Рекомендации по паттернам из ответа LLM"""
+    return [
+        PatternRecommendation(
+            name=pattern_data.get("name", ""),
+            category=(
+                pattern_data["category"]
+                if isinstance(pattern_data.get("category"), str) and pattern_data["category"] in PATTERN_CATEGORIES
+                else "behavioral"
+            ),
+            reason=pattern_data.get("reason", ""),
+            how_to_apply=pattern_data.get("how_to_apply", ""),
+            components_affected=pattern_data.get("components_affected", []),
+            example=pattern_data.get("example", "")
+        )
+        for pattern_data in parsed.get("patterns", [])
+    ]
 
 
 # ============================================================================
@@ -840,28 +1012,18 @@ async def select_patterns(
 # ============================================================================
 
 async def plan_integration(
-    components: List[ComponentSpec],
-    existing_arch: ExistingArchitecture,
-    repo_context: Dict[str, Any]
+    components_info: List[Dict[str, Any]],
+    shared_prefix: str
 ) -> Tuple[List[IntegrationPoint], List[ExternalDependency]]:
     """
     Планирует интеграцию с существующим кодом
     """
     
-    new_components = [{"name": c.name, "type": c.type.value} for c in components]
-    existing_components = existing_arch.existing_components[:50]
-    
     prompt = f"""
 Спланируй интеграцию новых компонентов с существующим кодом.
 
 ## НОВЫЕ КОМПОНЕНТЫ:
-{json.dumps(new_components, indent=2)}
-
-## СУЩЕСТВУЮЩИЕ КОМПОНЕНТЫ:
-{json.dumps(existing_components, indent=2, ensure_ascii=False)}
-
-## СУЩЕСТВУЮЩИЕ ФАЙЛЫ:
-{json.dumps(list(repo_context.get("key_files", {}).keys())[:20], indent=2)}
+{dumps_json(components_info)}
 
 ## ОПРЕДЕЛИ:
 
@@ -894,29 +1056,33 @@ async def plan_integration(
 }}
 """
     
-    response = await call_llm(prompt, step_name="plan_integration")
+    response = await call_llm(prompt, step_name="plan_integration", prefix=shared_prefix)
     parsed = parse_json_response(response)
 
-    integration_points = []
-    dependencies = []
+    return parse_integration(parsed) if parsed else ([], [])
 
-    if parsed:
-        for point_data in parsed.get("integration_points", []):
-            integration_points.append(IntegrationPoint(
-                existing_component=point_data.get("existing_component", ""),
-                new_component=point_data.get("new_component", ""),
-                integration_type=point_data.get("integration_type", "dependency"),
-                description=point_data.get("description", ""),
-                changes_required=point_data.get("changes_required", [])
-            ))
-
-        for dep_data in parsed.get("external_dependencies", []):
-            dependencies.append(ExternalDependency(
-                name=dep_data.get("name", ""),
-                version=dep_data.get("version", ""),
-                purpose=dep_data.get("purpose", ""),
-                package_manager=dep_data.get("package_manager", "")
-            ))
+
+def parse_integration(parsed: Dict[str, Any]) -> Tuple[List[IntegrationPoint], List[ExternalDependency]]:
+    """Точки интеграции и внешние зависимости из ответа LLM"""
+    integration_points = [
+        IntegrationPoint(
+            existing_component=point_data.get("existing_component", ""),
+            new_component=point_data.get("new_component", ""),
+            integration_type=point_data.get("integration_type", "dependency"),
+            description=point_data.get("description", ""),
+            changes_required=point_data.get("changes_required", [])
+        )
+        for point_data in parsed.get("integration_points", [])
+    ]
+    dependencies = [
+        ExternalDependency(
+            name=dep_data.get("name", ""),
+            version=dep_data.get("version", ""),
+            purpose=dep_data.get("purpose", ""),
+            package_manager=dep_data.get("package_manager", "")
+        )
+        for dep_data in parsed.get("external_dependencies", [])
+    ]
 
     return integration_points, dependencies
 
@@ -927,42 +1093,32 @@ async def plan_integration(
 
 async def generate_diagrams(
     components: List[ComponentSpec],
+    components_info: List[Dict[str, Any]],
     interfaces: List[InterfaceSpec],
     relations: List[ComponentRelation],
-    file_structure: List[FileSpec],
     tech_stack: TechStack
 ) -> List[DiagramSpec]:
     """
     Генерирует архитектурные диаграммы
     """
     
-    diagrams = []
-    
-    # 1. Component Diagram
-    component_diagram = await generate_component_diagram(components, relations)
-    if component_diagram:
-        diagrams.append(component_diagram)
-    
-    # 2. Class Diagram
-    class_diagram = await generate_class_diagram(components, interfaces, relations)
-    if class_diagram:
-        diagrams.append(class_diagram)
+    # Component Diagram и Class Diagram независимы, генерируем параллельно
+    component_diagram, class_diagram = await asyncio.gather(
+        generate_component_diagram(components_info, relations),
+        generate_class_diagram(components, interfaces, relations)
+    )
     
-    return diagrams
+    return [d for d in (component_diagram, class_diagram) if d]
 
 
 async def generate_component_diagram(
-    components: List[ComponentSpec],
+    components_info: List[Dict[str, Any]],
     relations: List[ComponentRelation]
 ) -> Optional[DiagramSpec]:
     """Генерирует диаграмму компонентов"""
     
-    components_info = [
-        {"name": c.name, "type": c.type.value, "layer": c.layer}
-        for c in components
-    ]
     relations_info = [
-        {"source": r.source, "target": r.target, "type": r.relation_type.value}
+        {"source": r.source, "target": r.target, "type": r.relation_type}
         for r in relations
     ]
     
@@ -970,10 +1126,10 @@ async def generate_component_diagram(
 Создай PlantUML диаграмму компонентов.
 
 ## КОМПОНЕНТЫ:
-{json.dumps(components_info, indent=2)}
+{dumps_json(components_info)}
 
 ## СВЯЗИ:
-{json.dumps(relations_info, indent=2)}
+{dumps_json(relations_info)}
 
 ## ТРЕБОВАНИЯ:
 1. Группируй по слоям (packages)
@@ -992,7 +1148,7 @@ async def generate_component_diagram(
 
     if plantuml_code:
         return DiagramSpec(
-            type=DiagramType.COMPONENT,
+            type="component",
             title="Component Diagram",
             description="Architecture component diagram",
             plantuml_code=plantuml_code,
@@ -1010,33 +1166,34 @@ async def generate_class_diagram(
     """Генерирует диаграмму классов"""
     
     # Формируем информацию о классах
-    classes_info = []
-    for comp in components:
-        methods = [{"name": m.name, "params": [p.name for p in m.parameters], "return": m.return_type}
-                   for m in comp.methods]
-        props = [{"name": p.name, "type": p.type} for p in comp.properties]
-        classes_info.append({
+    classes_info = [
+        {
             "name": comp.name,
-            "type": comp.type.value,
-            "methods": methods,
-            "properties": props,
+            "type": comp.type,
+            "methods": [
+                {"name": m.name, "params": [p.name for p in m.parameters], "return": m.return_type}
+                for m in comp.methods
+            ],
+            "properties": [{"name": p.name, "type": p.type} for p in comp.properties],
             "extends": comp.extends,
             "implements": comp.implements
-        })
+        }
+        for comp in components
+    ]
     
-    interfaces_info = []
-    for iface in interfaces:
-        methods = [{"name": m.name, "return": m.return_type} for m in iface.methods]
-        interfaces_info.append({"name": iface.name, "methods": methods})
+    interfaces_info = [
+        {"name": iface.name, "methods": [{"name": m.name, "return": m.return_type} for m in iface.methods]}
+        for iface in interfaces
+    ]
     
     prompt = f"""
 Создай PlantUML диаграмму классов.
 
 ## КЛАССЫ:
-{json.dumps(classes_info, indent=2, ensure_ascii=False)}
+{dumps_json(classes_info)}
 
 ## ИНТЕРФЕЙСЫ:
-{json.dumps(interfaces_info, indent=2, ensure_ascii=False)}
+{dumps_json(interfaces_info)}
 
 ## ТРЕБОВАНИЯ:
 1. Покажи все классы с методами и свойствами
@@ -1053,7 +1210,7 @@ async def generate_class_diagram(
     
     if plantuml_code:
         return DiagramSpec(
-            type=DiagramType.CLASS,
+            type="class",
             title="Class Diagram",
             description="Class diagram with interfaces",
             plantuml_code=plantuml_code,
@@ -1063,28 +1220,23 @@ async def generate_class_diagram(
     return None
 
 
+_PUML_FENCE_RE = re.compile(r'```(?:plantuml|puml)?\n?')
+_FENCE_RE = re.compile(r'```')
+# Целые строки от @startuml до @enduml включительно (или до конца, если @enduml нет)
+_PLANTUML_BLOCK_RE = re.compile(r'[^\n]*?@startuml.*?(?:@enduml[^\n]*|\Z)', re.DOTALL)
+
+
 def extract_plantuml(response: str) -> str:
     """Извлекает PlantUML код из ответа"""
     
     # Удаляем markdown блоки
-    response = re.sub(r'```(?:plantuml|puml)?\n?', '', response)
-    response = re.sub(r'```', '', response)
+    response = _PUML_FENCE_RE.sub('', response)
+    response = _FENCE_RE.sub('', response)
     
     # Ищем @startuml ... @enduml
-    lines = response.split('\n')
-    plantuml_lines = []
-    in_plantuml = False
-    
-    for line in lines:
-        if '@startuml' in line:
-            in_plantuml = True
-        if in_plantuml:
-            plantuml_lines.append(line)
-        if '@enduml' in line:
-            break
-    
-    if plantuml_lines:
-        return '\n'.join(plantuml_lines)
+    match = _PLANTUML_BLOCK_RE.search(response)
+    if match:
+        return match.group(0)
     
     return ""
 
@@ -1096,8 +1248,7 @@ def extract_plantuml(response: str) -> str:
 async def generate_recommendations(
     task: str,
     components: List[ComponentSpec],
-    existing_arch: ExistingArchitecture,
-    tech_stack: TechStack
+    shared_prefix: str
 ) -> Tuple[List[str], List[str]]:
     """
     Генерирует рекомендации и риски
@@ -1110,11 +1261,7 @@ async def generate_recommendations(
 {task}
 
 ## НОВЫЕ КОМПОНЕНТЫ:
-{json.dumps([c.name for c in components], indent=2)}
-
-## СУЩЕСТВУЮЩАЯ АРХИТЕКТУРА:
-- Паттерн: {existing_arch.pattern}
-- Слабости: {existing_arch.weaknesses}
+{dumps_json([c.name for c in components])}
 
 ## ДАЙТЕ:
 
@@ -1143,7 +1290,7 @@ async def generate_recommendations(
 }}
 """
     
-    response = await call_llm(prompt, step_name="generate_recommendations")
+    response = await call_llm(prompt, step_name="generate_recommendations", prefix=shared_prefix)
     parsed = parse_json_response(response)
 
     if parsed:
@@ -1152,10 +1299,169 @@ async def generate_recommendations(
     return [], []
 
 
+# ============================================================================
+# BATCHED PLANNING
+# ============================================================================
+
+async def plan_design_batch(
+    task: str,
+    components_info: List[Dict[str, Any]],
+    interfaces: List[InterfaceSpec],
+    shared_prefix: str
+) -> Tuple[
+    List[FileSpec],
+    List[PatternRecommendation],
+    Tuple[List[IntegrationPoint], List[ExternalDependency]],
+    Tuple[List[str], List[str]]
+]:
+    """
+    Шаги 3, 4, 5 и 7 одним запросом к LLM: структура файлов, паттерны,
+    интеграция и рекомендации. Ответ разбирается теми же парсерами,
+    что и у отдельных шагов
+    """
+    
+    prompt = f"""
+Спланируй реализацию новых компонентов: структуру файлов, паттерны проектирования,
+интеграцию с существующим кодом, рекомендации и риски.
+
+## ЗАДАЧА:
+{task}
+
+## КОМПОНЕНТЫ:
+{dumps_json(components_info)}
+
+## ИНТЕРФЕЙСЫ:
+{dumps_json([{"name": i.name} for i in interfaces])}
+
+## ТРЕБОВАНИЯ:
+1. **Файлы**: следуй существующим соглашениям по именованию, группируй связанные компоненты
+   по слоям архитектуры, не складывай всё в корневую директорию
+2. **Паттерны**: creational, structural, behavioral или architectural
+   (Repository, Unit of Work, CQRS, Event Sourcing, DI Container)
+3. **Интеграция**: где новые компоненты подключаются к существующим, какие файлы
+   нужно изменить, какие внешние библиотеки нужны
+4. **Рекомендации** (5-7 штук) и **риски** (3-5 штук)
+
+## ФОРМАТ ОТВЕТА (JSON):
+{{
+    "files": [
+        {{
+            "path": "путь/к/файлу.расширение",
+            "type": "module | package | test | config | schema",
+            "description": "Краткое описание назначения файла",
+            "contains": ["Класс1", "функция1"],
+            "imports_from": ["путь/к/зависимости1"],
+            "exports": ["Класс1"]
+        }}
+    ],
+    "patterns": [
+        {{
+            "name": "Strategy",
+            "category": "behavioral",
+            "reason": "Почему паттерн подходит",
+            "how_to_apply": "Как применить",
+            "components_affected": ["Компонент1"],
+            "example": "Короткий пример кода"
+        }}
+    ],
+    "integration_points": [
+        {{
+            "existing_component": "UserService",
+            "new_component": "JWTAuthenticator",
+            "integration_type": "dependency",
+            "description": "Как компоненты связаны",
+            "changes_required": ["Изменение 1"]
+        }}
+    ],
+    "external_dependencies": [
+        {{
+            "name": "pyjwt",
+            "version": ">=2.8.0",
+            "purpose": "JWT токены",
+            "package_manager": "pip"
+        }}
+    ],
+    "recommendations": ["Рекомендация 1"],
+    "risks": ["Риск 1"]
+}}
+"""
+    
+    response = await call_llm(prompt, step_name="plan_design_batch", prefix=shared_prefix)
+    parsed = parse_json_response(response)
+
+    if not parsed:
+        return [], [], ([], []), ([], [])
+
+    return (
+        parse_file_structure(parsed),
+        parse_patterns(parsed),
+        parse_integration(parsed),
+        (parsed.get("recommendations", []), parsed.get("risks", []))
+    )
+
+
 # ============================================================================
 # MAIN ARCHITECTURE DESIGN
 # ============================================================================
 
+def rank_existing_components(
+    existing_arch: ExistingArchitecture,
+    task: str,
+    top_k: int = EXISTING_COMPONENTS_TOP_K
+) -> List[Dict[str, Any]]:
+    """
+    Отбирает top_k существующих компонентов, наиболее близких к задаче.
+    Оценка - сумма IDF общих с задачей терминов; при равенстве сохраняется
+    исходный порядок, без совпадений берутся первые top_k
+    """
+    components = existing_arch.existing_components
+    if len(components) <= top_k:
+        return components
+    
+    component_terms = existing_arch.component_terms()
+    document_frequency = collections.Counter(
+        term for terms in component_terms for term in terms
+    )
+    task_terms = extract_terms(task) & document_frequency.keys()
+    if not task_terms:
+        return components[:top_k]
+    
+    total = len(components)
+    idf = {term: math.log(total / document_frequency[term]) for term in task_terms}
+    scores = [sum(idf[term] for term in task_terms & terms) for terms in component_terms]
+    best = heapq.nlargest(top_k, range(total), key=lambda i: (scores[i], -i))
+    return [components[i] for i in sorted(best)]
+
+
+def build_shared_prefix(
+    task: str,
+    existing_arch: ExistingArchitecture,
+    tech_stack: TechStack,
+    repo_context: Dict[str, Any]
+) -> str:
+    """
+    Контекст проекта, общий для шагов 2-7. Строится один раз и передаётся
+    каждому шагу без изменений, чтобы провайдер мог закэшировать префикс
+    """
+    return f"""## СУЩЕСТВУЮЩАЯ АРХИТЕКТУРА:
+- Паттерн: {existing_arch.pattern}
+- Слои: {', '.join(existing_arch.layers)}
+- Соглашения: {orjson.dumps(existing_arch.conventions).decode()}
+- Слабости: {existing_arch.weaknesses}
+
+## СУЩЕСТВУЮЩИЕ КОМПОНЕНТЫ:
+{dumps_json(rank_existing_components(existing_arch, task))}
+
+## СУЩЕСТВУЮЩИЕ ФАЙЛЫ:
+{dumps_json(list(repo_context.get("key_files", {}).keys())[:20])}
+
+## ТЕХНОЛОГИИ:
+- Язык: {tech_stack.primary_language}
+- Фреймворки: {', '.join(tech_stack.frameworks)}
+- Тестирование: {', '.join(tech_stack.testing_frameworks)}
+"""
+
+
 async def design_architecture(
     task: str,
     tech_stack: TechStack,
@@ -1169,53 +1475,60 @@ async def design_architecture(
     logger.info("Analyzing existing architecture...")
     existing_arch = await analyze_existing_architecture(repo_context, tech_stack)
     
+    # Общий контекст для шагов 2-7
+    shared_prefix = build_shared_prefix(task, existing_arch, tech_stack, repo_context)
+    
     # 2. Проектирование компонентов
     logger.info("Designing components...")
-    components, interfaces, relations = await design_components(
-        task, existing_arch, tech_stack, repo_context
-    )
-    
-    # 3. Планирование структуры файлов
-    logger.info("Planning file structure...")
-    file_structure = await plan_file_structure(
-        components, interfaces, existing_arch, tech_stack
-    )
-    
-    # 4. Выбор паттернов
-    logger.info("Selecting patterns...")
-    patterns = await select_patterns(task, components, tech_stack)
-    
-    # 5. Планирование интеграции
-    logger.info("Planning integration...")
-    integration_points, dependencies = await plan_integration(
-        components, existing_arch, repo_context
-    )
+    components, interfaces, relations = await design_components(task, shared_prefix)
     
-    # 6. Генерация диаграмм
-    logger.info("Generating diagrams...")
-    diagrams = await generate_diagrams(
-        components, interfaces, relations, file_structure, tech_stack
-    )
+    # Краткое описание компонентов, общее для шагов 3-6
+    components_info = build_components_info(components)
     
-    # 7. Рекомендации
-    logger.info("Generating recommendations...")
-    recommendations, risks = await generate_recommendations(
-        task, components, existing_arch, tech_stack
-    )
+    # 3-7. Шаги зависят только от компонентов и анализа, выполняем параллельно
+    logger.info("Planning file structure, patterns, integration, diagrams and recommendations...")
+    if BATCH_DESIGN_STEPS:
+        # Шаги 3, 4, 5 и 7 одним запросом, диаграммы отдельно
+        (
+            (file_structure, patterns, (integration_points, dependencies), (recommendations, risks)),
+            diagrams
+        ) = await asyncio.gather(
+            plan_design_batch(task, components_info, interfaces, shared_prefix),
+            generate_diagrams(components, components_info, interfaces, relations, tech_stack)
+        )
+    else:
+        (
+            file_structure,
+            patterns,
+            (integration_points, dependencies),
+            diagrams,
+            (recommendations, risks)
+        ) = await asyncio.gather(
+            # 3. Планирование структуры файлов
+            plan_file_structure(components_info, interfaces, shared_prefix),
+            # 4. Выбор паттернов
+            select_patterns(task, components_info, shared_prefix),
+            # 5. Планирование интеграции
+            plan_integration(components_info, shared_prefix),
+            # 6. Генерация диаграмм
+            generate_diagrams(components, components_info, interfaces, relations, tech_stack),
+            # 7. Рекомендации
+            generate_recommendations(task, components, shared_prefix)
+        )
     
     # Собираем результат
-    design = ArchitectureDesign(
-        components=components,
-        interfaces=interfaces,
-        relations=relations,
-        file_structure=file_structure,
-        patterns=patterns,
-        external_dependencies=dependencies,
-        integration_points=integration_points,
-        diagrams=diagrams,
-        recommendations=recommendations,
-        risks=risks
-    )
+    design = ARCHITECTURE_DESIGN_ADAPTER.validate_python({
+        "components": components,
+        "interfaces": interfaces,
+        "relations": relations,
+        "file_structure": file_structure,
+        "patterns": patterns,
+        "external_dependencies": dependencies,
+        "integration_points": integration_points,
+        "diagrams": diagrams,
+        "recommendations": recommendations,
+        "risks": risks
+    })
     
     return existing_arch, design
 
@@ -1224,6 +1537,16 @@ async def design_architecture(
 # MAIN ENDPOINT
 # ============================================================================
 
+def parse_tech_stack(tech_stack_data: Any) -> TechStack:
+    """TechStack из тела запроса; кривой tech_stack - ошибка клиента (422), а не 500"""
+    if not tech_stack_data:
+        return TechStack()
+    try:
+        return TechStack.from_dict(tech_stack_data)
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid tech_stack: {e}")
+
+
 @app.post("/process", response_model=ArchitectResponse)
 async def process_architecture(request: ArchitectRequest):
     """
@@ -1233,16 +1556,13 @@ async def process_architecture(request: ArchitectRequest):
     start_time = time.time()
     task_id = str(uuid.uuid4())
     
+    data = request.data
+    tech_stack = parse_tech_stack(data.get("tech_stack"))
+    repo_context = data.get("repo_context", {})
+    
     try:
-        data = request.data
-        
         logger.info(f"[{task_id[:8]}] Starting architecture design: {request.task[:100]}")
         
-        # Извлекаем данные
-        tech_stack_data = data.get("tech_stack", {})
-        tech_stack = TechStack(**tech_stack_data) if tech_stack_data else TechStack()
-        repo_context = data.get("repo_context", {})
-        
         # Выполняем проектирование
         existing_arch, design = await design_architecture(
             task=request.task,
@@ -1256,35 +1576,25 @@ async def process_architecture(request: ArchitectRequest):
                    f"components: {len(design.components)}, "
                    f"files: {len(design.file_structure)}")
         
-        # Формируем плоскую структуру для совместимости
-        components_flat = [c.dict() for c in design.components]
-        patterns_flat = [p.name for p in design.patterns]
-        file_structure_flat = [f.dict() for f in design.file_structure]
-        interfaces_flat = [i.dict() for i in design.interfaces]
-        dependencies_flat = [d.name for d in design.external_dependencies]
-        integration_flat = [ip.dict() for ip in design.integration_points]
-        diagrams_flat = {d.type.value: d.plantuml_code for d in design.diagrams}
+        # Плоская структура для Code Writer вычисляется из architecture
+        response = ARCHITECT_RESPONSE_ADAPTER.validate_python({
+            "task_id": task_id,
+            "status": "success",
+            "existing_architecture": existing_arch,
+            "architecture": design,
+            "duration_seconds": duration
+        })
         
-        return ArchitectResponse(
-            task_id=task_id,
-            status="success",
-            existing_architecture=existing_arch,
-            architecture=design,
-            # Плоская структура для Code Writer
-            components=components_flat,
-            patterns=patterns_flat,
-            file_structure=file_structure_flat,
-            interfaces=interfaces_flat,
-            dependencies=dependencies_flat,
-            integration_points=integration_flat,
-            diagrams=diagrams_flat,
-            recommendations=design.recommendations,
-            duration_seconds=duration
+        # Сериализуем сами: pydantic-core пишет JSON-байты за один проход,
+        # минуя jsonable_encoder и промежуточный dict
+        return Response(
+            content=ARCHITECT_RESPONSE_ADAPTER.dump_json(response),
+            media_type="application/json"
         )
         
     except Exception as e:
         logger.exception(f"[{task_id[:8]}] Architecture design error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail="Internal error")
 
 
 # ============================================================================
@@ -1292,105 +1602,96 @@ async def process_architecture(request: ArchitectRequest):
 # ============================================================================
 
 @app.post("/analyze")
-async def analyze_only(request: Dict[str, Any]):
+async def analyze_only(request: AnalyzeRequest):
     """
     Только анализ существующей архитектуры
     """
 
-    AGENT_ACTIVE_REQUESTS.labels(method="POST", endpoint="/analyze").inc()
-    start_time = time.time()
+    tech_stack = parse_tech_stack(request.tech_stack)
 
     try:
-        tech_stack_data = request.get("tech_stack", {})
-        tech_stack = TechStack(**tech_stack_data) if tech_stack_data else TechStack()
-        repo_context = request.get("repo_context", {})
-
-        existing_arch = await analyze_existing_architecture(repo_context, tech_stack)
+        existing_arch = await analyze_existing_architecture(request.repo_context, tech_stack)
 
-        duration = time.time() - start_time
+        # Готовый ORJSONResponse: без v1 .dict() и прохода jsonable_encoder
+        return ORJSONResponse(existing_arch.model_dump(mode="json"))
 
-        # Метрики
-        AGENT_REQUESTS_TOTAL.labels(method="POST", endpoint="/analyze", status="success").inc()
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method="POST", endpoint="/analyze").observe(duration)
+    except Exception as e:
+        logger.exception(f"Architecture analysis error: {e}")
+        raise HTTPException(status_code=500, detail="Internal error")
 
-        return existing_arch.dict()
 
-    except Exception as e:
-        AGENT_REQUESTS_TOTAL.labels(method="POST", endpoint="/analyze", status="error").inc()
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method="POST", endpoint="/analyze").observe(time.time() - start_time)
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        AGENT_ACTIVE_REQUESTS.labels(method="POST", endpoint="/analyze").dec()
+# Готовые JSON-тела ответов /diagram по отпечатку запроса (LRU)
+diagram_cache: "collections.OrderedDict[bytes, bytes]" = collections.OrderedDict()
 
 
 @app.post("/diagram")
-async def generate_diagram_only(request: Dict[str, Any]):
+async def generate_diagram_only(request: DiagramRequest):
     """
     Генерация отдельной диаграммы
     """
 
-    AGENT_ACTIVE_REQUESTS.labels(method="POST", endpoint="/diagram").inc()
-    start_time = time.time()
-
     try:
-        diagram_type = request.get("type", "component")
-        components = request.get("components", [])
-        relations = request.get("relations", [])
-
-        # Преобразуем в модели
-        comp_specs = []
-        for c in components:
-            try:
-                comp_specs.append(ComponentSpec(**c))
-            except:
-                pass
-
-        rel_specs = []
-        for r in relations:
-            try:
-                rel_specs.append(ComponentRelation(**r))
-            except:
-                pass
-
-        if diagram_type == "component":
-            diagram = await generate_component_diagram(comp_specs, rel_specs)
+        # Отпечаток по уже провалидированному запросу: порядок ключей не важен,
+        # id компонентов (генерируются, если не переданы) в диаграмму не попадают
+        cache_key = hashlib.blake2b(
+            request.model_dump_json(exclude={"components": {"__all__": {"id"}}}).encode(),
+            digest_size=16
+        ).digest()
+        cached = diagram_cache.get(cache_key)
+        if cached is not None:
+            diagram_cache.move_to_end(cache_key)
+            return Response(content=cached, media_type="application/json")
+
+        if request.type == "component":
+            diagram = await generate_component_diagram(build_components_info(request.components), request.relations)
         else:
-            diagram = await generate_class_diagram(comp_specs, [], rel_specs)
-
-        duration = time.time() - start_time
-
-        # Метрики
-        AGENT_REQUESTS_TOTAL.labels(method="POST", endpoint="/diagram", status="success").inc()
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method="POST", endpoint="/diagram").observe(duration)
+            diagram = await generate_class_diagram(request.components, [], request.relations)
 
         if diagram:
-            return diagram.dict()
+            result = ORJSONResponse(diagram.model_dump(mode="json"))
+            diagram_cache[cache_key] = result.body
+            if len(diagram_cache) > DIAGRAM_CACHE_SIZE:
+                diagram_cache.popitem(last=False)
+            return result
 
         return {"error": "Failed to generate diagram"}
 
     except Exception as e:
-        AGENT_REQUESTS_TOTAL.labels(method="POST", endpoint="/diagram", status="error").inc()
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method="POST", endpoint="/diagram").observe(time.time() - start_time)
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        AGENT_ACTIVE_REQUESTS.labels(method="POST", endpoint="/diagram").dec()
+        logger.exception(f"Diagram generation error: {e}")
+        raise HTTPException(status_code=500, detail="Internal error")
+
+
+# Тело /health не меняется: сериализуем один раз при загрузке модуля
+health_payload = orjson.dumps({
+    "status": "healthy",
+    "service": "architect",
+    "version": "2.0.0"
+})
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint - не экспортирует метрики"""
-    return {
-        "status": "healthy",
-        "service": "architect",
-        "version": "2.0.0",
-        "timestamp": datetime.now().isoformat()
-    }
+    return Response(content=health_payload, media_type="application/json")
+
+
+# Последний отрендеренный /metrics: (момент рендера, тело)
+metrics_cache: Tuple[float, bytes] = (0.0, b"")
 
 
 @app.get("/metrics")
 async def metrics():
     """Prometheus metrics endpoint - только метрики"""
-    return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    global metrics_cache
+    # Скрейперы, пришедшие в пределах METRICS_CACHE_TTL, получают один рендер.
+    # generate_latest синхронный, так что между проверкой и записью кэша
+    # другая корутина вклиниться не может - лок не нужен
+    now = time.monotonic()
+    rendered_at, payload = metrics_cache
+    if now - rendered_at > METRICS_CACHE_TTL:
+        payload = generate_latest()
+        metrics_cache = (now, payload)
+    return Response(content=payload, media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/")
@@ -1429,6 +1730,13 @@ if __name__ == "__main__":
         "server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        loop="uvloop",
+        http="httptools",
+        # reload несовместим с workers > 1 - только для локальной разработки
+        reload=os.getenv("ENV") == "dev",
+        workers=WORKERS,
+        limit_concurrency=LIMIT_CONCURRENCY,
+        backlog=BACKLOG,
+        timeout_keep_alive=TIMEOUT_KEEP_ALIVE,
         log_level="info"
     )
@@ -2,10 +2,12 @@
 Pydantic модели для Code Reviewer Agent
 """
 
+from collections import Counter, defaultdict
 from datetime import datetime
-from typing import Dict, List, Optional, Any, Union
+from typing import Dict, List, Optional, Any, Tuple, Union
 from enum import Enum
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, validator
+import secrets
 import uuid
 
 
@@ -32,22 +34,16 @@ class IssueSeverity(str, Enum):
         Returns:
             IssueSeverity или default
         """
-        try:
-            if not isinstance(value, str):
-                return default or cls.MEDIUM
-            
-            value_upper = value.upper()
-            if hasattr(cls, value_upper):
-                return getattr(cls, value_upper)
-            
-            # Проверка по значениям
-            for severity in cls:
-                if severity.value.lower() == value.lower():
-                    return severity
-            
-            return default or cls.MEDIUM
-        except Exception:
+        if not isinstance(value, str):
             return default or cls.MEDIUM
+        if value in cls._VALUES:
+            return cls(value)
+        return (
+            cls._BY_VALUE.get(value.casefold())
+            or cls._BY_NAME.get(value.upper())
+            or default
+            or cls.MEDIUM
+        )
 
 
 class IssueType(str, Enum):
@@ -78,22 +74,25 @@ class IssueType(str, Enum):
         Returns:
             IssueType или default
         """
-        try:
-            if not isinstance(value, str):
-                return default or cls.MAINTAINABILITY
-            
-            value_upper = value.upper()
-            if hasattr(cls, value_upper):
-                return getattr(cls, value_upper)
-            
-            # Проверка по значениям
-            for issue_type in cls:
-                if issue_type.value.lower() == value.lower():
-                    return issue_type
-            
-            return default or cls.MAINTAINABILITY
-        except Exception:
+        if not isinstance(value, str):
             return default or cls.MAINTAINABILITY
+        if value in cls._VALUES:
+            return cls(value)
+        return (
+            cls._BY_VALUE.get(value.casefold())
+            or cls._BY_NAME.get(value.upper())
+            or default
+            or cls.MAINTAINABILITY
+        )
+
+
+# Таблицы для from_string: Enum закрыт после объявления, поэтому заполняем здесь.
+# _VALUES - канонические значения (частый случай ответа LLM) для проверки за один хэш
+for _enum_cls in (IssueSeverity, IssueType):
+    _enum_cls._BY_NAME = {m.name: m for m in _enum_cls}
+    _enum_cls._BY_VALUE = {m.value.casefold(): m for m in _enum_cls}
+    _enum_cls._VALUES = frozenset(m.value for m in _enum_cls)
+del _enum_cls
 
 
 class ReviewDecision(str, Enum):
@@ -115,6 +114,8 @@ class CodeLocation(BaseModel):
     column_start: Optional[int] = None
     column_end: Optional[int] = None
     
+    model_config = ConfigDict(frozen=True)
+    
     def __str__(self) -> str:
         loc = self.file_path
         if self.line_start:
@@ -126,7 +127,7 @@ class CodeLocation(BaseModel):
 
 class ReviewIssue(BaseModel):
     """Замечание по коду"""
-    id: str = Field(default_factory=lambda: str(uuid.uuid4())[:8])
+    id: str = Field(default_factory=lambda: secrets.token_hex(4))
     type: IssueType
     severity: IssueSeverity
     title: str
@@ -148,8 +149,9 @@ class ReviewIssue(BaseModel):
     references: List[str] = Field(default_factory=list)  # Ссылки на документацию
     effort_to_fix: str = "low"  # low, medium, high
     
-    class Config:
-        extra = "allow"
+    # Все поля заполняются явно из ответа LLM, лишние ключи не нужны:
+    # без extra="allow" экземпляр не держит __pydantic_extra__
+    model_config = ConfigDict(extra="ignore", frozen=True)
     
     @property
     def location(self) -> str:
@@ -171,6 +173,8 @@ class FileSummary(BaseModel):
     high_count: int = 0
     quality_score: float = 10.0
     recommendations: List[str] = Field(default_factory=list)
+    
+    model_config = ConfigDict(frozen=True)
 
 
 # ============================================================================
@@ -184,6 +188,8 @@ class ArchitectureCheck(BaseModel):
     actual: str
     compliant: bool
     issue: Optional[str] = None
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class ArchitectureCompliance(BaseModel):
@@ -220,6 +226,44 @@ class ReviewMetrics(BaseModel):
     maintainability_score: float = 0.0
     performance_score: float = 0.0
     
+    @classmethod
+    def from_issues(
+        cls,
+        issues: List['ReviewIssue'],
+        total_files: int,
+        total_lines: int,
+        overall_quality_score: float
+    ) -> 'ReviewMetrics':
+        """
+        Собирает метрики за один проход по issues
+        
+        Args:
+            issues: Список проблем ревью
+            total_files: Количество проверенных файлов
+            total_lines: Суммарное число строк
+            overall_quality_score: Итоговая оценка качества
+            
+        Returns:
+            ReviewMetrics
+        """
+        by_severity = Counter(issue.severity for issue in issues)
+        by_type = Counter(issue.type for issue in issues)
+        blocking = by_severity[IssueSeverity.CRITICAL] + by_severity[IssueSeverity.HIGH]
+        
+        return cls(
+            total_files=total_files,
+            total_lines=total_lines,
+            total_issues=len(issues),
+            critical_issues=by_severity[IssueSeverity.CRITICAL],
+            high_issues=by_severity[IssueSeverity.HIGH],
+            medium_issues=by_severity[IssueSeverity.MEDIUM],
+            low_issues=by_severity[IssueSeverity.LOW],
+            bugs=by_type[IssueType.BUG],
+            performance_issues=by_type[IssueType.PERFORMANCE],
+            overall_quality_score=overall_quality_score,
+            maintainability_score=10.0 - blocking * 0.5
+        )
+    
     def get_metric(self, metric_name: str, default=None):
         """
         Безопасный доступ к метрике с обработкой ошибок
@@ -259,21 +303,18 @@ class ReviewMetrics(BaseModel):
                     "low_ratio": 0.0
                 }
             
-            total_issues = len(issues)
+            total_issues = len(issues)  # > 0: пустой список обработан выше
             files_count = max(1, self.total_files)  # Предотвращаем деление на ноль
             
-            # Расчет соотношений по серьезности
-            critical_count = sum(1 for issue in issues if hasattr(issue, 'severity') and issue.severity == 'critical')
-            high_count = sum(1 for issue in issues if hasattr(issue, 'severity') and issue.severity == 'high')
-            medium_count = sum(1 for issue in issues if hasattr(issue, 'severity') and issue.severity == 'medium')
-            low_count = sum(1 for issue in issues if hasattr(issue, 'severity') and issue.severity == 'low')
+            # Соотношения по серьезности за один проход
+            counts = Counter(issue.severity for issue in issues)
             
             return {
                 "issues_per_file": total_issues / files_count,
-                "critical_ratio": critical_count / total_issues if total_issues > 0 else 0.0,
-                "high_ratio": high_count / total_issues if total_issues > 0 else 0.0,
-                "medium_ratio": medium_count / total_issues if total_issues > 0 else 0.0,
-                "low_ratio": low_count / total_issues if total_issues > 0 else 0.0
+                "critical_ratio": counts[IssueSeverity.CRITICAL] / total_issues,
+                "high_ratio": counts[IssueSeverity.HIGH] / total_issues,
+                "medium_ratio": counts[IssueSeverity.MEDIUM] / total_issues,
+                "low_ratio": counts[IssueSeverity.LOW] / total_issues
             }
         except Exception as e:
             # Возвращаем пустые метрики в случае ошибки
@@ -313,71 +354,89 @@ class ReviewResult(BaseModel):
     # Для итерации
     blocking_issues: List[str] = Field(default_factory=list)  # ID issues которые блокируют
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
+    
+    # Индексы issues по severity, типу и файлу. Строятся лениво при первой выборке
+    # и перестраиваются, если issues заменили или изменили его длину.
+    # Корзины - кортежи: выборки отдают их без копирования
+    _by_severity: Dict[IssueSeverity, Tuple[ReviewIssue, ...]] = PrivateAttr(default_factory=dict)
+    _by_type: Dict[IssueType, Tuple[ReviewIssue, ...]] = PrivateAttr(default_factory=dict)
+    _by_file: Dict[str, Tuple[ReviewIssue, ...]] = PrivateAttr(default_factory=dict)
+    # Снимок issues, по которому построены индексы: (список, длина)
+    _indexed: Tuple[Optional[List[ReviewIssue]], int] = PrivateAttr(default=(None, -1))
+    
+    def _indexes_fresh(self) -> bool:
+        indexed_issues, indexed_len = self._indexed
+        return indexed_issues is self.issues and indexed_len == len(self.issues)
+    
+    def _ensure_indexes(self) -> None:
+        if not self._indexes_fresh():
+            self._build_indexes()
+    
+    def _build_indexes(self) -> None:
+        by_severity = defaultdict(list)
+        by_type = defaultdict(list)
+        by_file = defaultdict(list)
+        for issue in self.issues:
+            by_severity[issue.severity].append(issue)
+            by_type[issue.type].append(issue)
+            if issue.file_path:
+                by_file[issue.file_path].append(issue)
+        self._by_severity = {key: tuple(bucket) for key, bucket in by_severity.items()}
+        self._by_type = {key: tuple(bucket) for key, bucket in by_type.items()}
+        self._by_file = {key: tuple(bucket) for key, bucket in by_file.items()}
+        self._indexed = (self.issues, len(self.issues))
+        if __debug__:
+            self._check_index()
+    
+    def _check_index(self) -> None:
+        indexed = sum(len(bucket) for bucket in self._by_severity.values())
+        assert indexed == len(self.issues), (
+            f"ReviewResult index out of sync: {indexed} indexed, {len(self.issues)} issues"
+        )
     
     @property
-    def critical_issues(self) -> List[ReviewIssue]:
-        """Безопасное получение критических проблем"""
-        try:
-            if not self.issues:
-                return []
-            return [i for i in self.issues if hasattr(i, 'severity') and i.severity == IssueSeverity.CRITICAL]
-        except Exception:
-            return []
+    def critical_issues(self) -> Tuple[ReviewIssue, ...]:
+        """Критические проблемы"""
+        return self.get_issues_by_severity(IssueSeverity.CRITICAL)
     
     @property
-    def high_issues(self) -> List[ReviewIssue]:
-        """Безопасное получение высокоприоритетных проблем"""
-        try:
-            if not self.issues:
-                return []
-            return [i for i in self.issues if hasattr(i, 'severity') and i.severity == IssueSeverity.HIGH]
-        except Exception:
-            return []
-    
-    def get_issues_for_file(self, file_path: str) -> List[ReviewIssue]:
-        """Безопасное получение проблем для конкретного файла"""
-        try:
-            if not self.issues or not file_path:
-                return []
-            return [i for i in self.issues if hasattr(i, 'file_path') and i.file_path == file_path]
-        except Exception:
-            return []
-    
-    def get_issues_by_severity(self, severity: IssueSeverity) -> List[ReviewIssue]:
+    def high_issues(self) -> Tuple[ReviewIssue, ...]:
+        """Высокоприоритетные проблемы"""
+        return self.get_issues_by_severity(IssueSeverity.HIGH)
+    
+    def get_issues_for_file(self, file_path: str) -> Tuple[ReviewIssue, ...]:
+        """Проблемы для конкретного файла"""
+        if not file_path:
+            return ()
+        self._ensure_indexes()
+        return self._by_file.get(file_path, ())
+    
+    def get_issues_by_severity(self, severity: IssueSeverity) -> Tuple[ReviewIssue, ...]:
         """
-        Безопасное получение проблем по уровню серьезности
+        Получение проблем по уровню серьезности
         
         Args:
             severity: Уровень серьезности
             
         Returns:
-            Список проблем указанного уровня серьезности
+            Кортеж проблем указанного уровня серьезности
         """
-        try:
-            if not self.issues:
-                return []
-            return [i for i in self.issues if hasattr(i, 'severity') and i.severity == severity]
-        except Exception:
-            return []
+        self._ensure_indexes()
+        return self._by_severity.get(severity, ())
     
-    def get_issues_by_type(self, issue_type: IssueType) -> List[ReviewIssue]:
+    def get_issues_by_type(self, issue_type: IssueType) -> Tuple[ReviewIssue, ...]:
         """
-        Безопасное получение проблем по типу
+        Получение проблем по типу
         
         Args:
             issue_type: Тип проблемы
             
         Returns:
-            Список проблем указанного типа
+            Кортеж проблем указанного типа
         """
-        try:
-            if not self.issues:
-                return []
-            return [i for i in self.issues if hasattr(i, 'type') and i.type == issue_type]
-        except Exception:
-            return []
+        self._ensure_indexes()
+        return self._by_type.get(issue_type, ())
     
     def get_summary_stats(self) -> Dict[str, Any]:
         """
@@ -387,45 +446,18 @@ class ReviewResult(BaseModel):
             Словарь со статистикой
         """
         try:
-            if not self.issues:
-                return {
-                    "total_issues": 0,
-                    "by_severity": {
-                        "critical": 0,
-                        "high": 0,
-                        "medium": 0,
-                        "low": 0
-                    },
-                    "by_type": {},
-                    "files_affected": 0
-                }
-            
-            # Подсчет по серьезности
+            self._ensure_indexes()
             severity_counts = {
-                "critical": len(self.critical_issues),
-                "high": len(self.high_issues),
-                "medium": len([i for i in self.issues if hasattr(i, 'severity') and i.severity == IssueSeverity.MEDIUM]),
-                "low": len([i for i in self.issues if hasattr(i, 'severity') and i.severity == IssueSeverity.LOW])
+                severity.value: len(self._by_severity.get(severity, ()))
+                for severity in (IssueSeverity.CRITICAL, IssueSeverity.HIGH, IssueSeverity.MEDIUM, IssueSeverity.LOW)
             }
-            
-            # Подсчет по типам
-            type_counts = {}
-            for issue in self.issues:
-                if hasattr(issue, 'type') and issue.type:
-                    type_name = issue.type.value if hasattr(issue.type, 'value') else str(issue.type)
-                    type_counts[type_name] = type_counts.get(type_name, 0) + 1
-            
-            # Подсчет затронутых файлов
-            files_affected = len(set(
-                i.file_path for i in self.issues
-                if hasattr(i, 'file_path') and i.file_path
-            ))
+            type_counts = {issue_type.value: len(bucket) for issue_type, bucket in self._by_type.items()}
             
             return {
                 "total_issues": len(self.issues),
                 "by_severity": severity_counts,
                 "by_type": type_counts,
-                "files_affected": files_affected
+                "files_affected": len(self._by_file)
             }
         except Exception as e:
             return {
@@ -449,8 +481,7 @@ class CodeFile(BaseModel):
     description: str = ""
     action: str = "create"
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="ignore")
 
 
 class CodeReviewRequest(BaseModel):
@@ -471,8 +502,7 @@ class CodeReviewResponse(BaseModel):
     reviewed_files: int = 0
     duration_seconds: float = 0.0
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -487,8 +517,7 @@ class FileReviewHistory(BaseModel):
     last_review_attempt: int = 0  # Последняя попытка ревью
     is_fixed: bool = False  # Помечены ли все issues как исправленные
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class ReviewBatchState(BaseModel):
@@ -550,8 +579,7 @@ class ReviewBatchState(BaseModel):
         self.final_decision = final_decision
         self.updated_at = datetime.now()
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 class ReviewBatchMetrics(BaseModel):
@@ -603,8 +631,7 @@ class ReviewBatchMetrics(BaseModel):
         self.estimated_sequential_time = estimated_sequential_time
         self.processing_speedup = speedup
     
-    class Config:
-        extra = "allow"
+    model_config = ConfigDict(extra="allow")
 
 
 # ============================================================================
@@ -623,5 +650,4 @@ class TechStack(BaseModel):
     ci_cd: List[str] = Field(default_factory=list)
     architecture_patterns: List[str] = Field(default_factory=list)
     
-    class Config:
-        extra = "allow"
\ No newline at end of file
+    model_config = ConfigDict(extra="allow")
\ No newline at end of file
@@ -20,19 +20,23 @@ Code Reviewer Agent - Проверяет код от Code Writer
 """
 
 import os
-import json
 import logging
 import re
 import time
 import uuid
 import asyncio
+import collections
+import hashlib
+import itertools
 from datetime import datetime
+from functools import lru_cache
 from typing import Dict, List, Optional, Any, Tuple
 
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse, PlainTextResponse
 import httpx
+import orjson
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 
 from models import (
@@ -57,9 +61,15 @@ LLM_TIMEOUT = 1000
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL")
 
 # Настройки параллельной обработки
-MAX_CONCURRENT_LLM_REQUESTS = 5  # Максимальное количество одновременных запросов к LLM
+MAX_CONCURRENT_LLM_REQUESTS = int(os.getenv("MAX_CONCURRENT_LLM_REQUESTS", "5"))  # Максимальное количество одновременных запросов к LLM
 llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_REQUESTS)
 
+# Кэш результатов check_code_quality по содержимому файла (LRU).
+# QUALITY_PROMPT_VERSION нужно увеличивать при изменении промпта проверки
+QUALITY_CACHE_SIZE = int(os.getenv("QUALITY_CACHE_SIZE", "1024"))
+QUALITY_PROMPT_VERSION = "2"
+QUALITY_PROMPT_CODE_LIMIT = 15000  # Символов JSON с кодом файла в промпте
+
 # Пороги качества (смягченные)
 QUALITY_THRESHOLDS = {
     "approve_min_score": 4.0,       # Сильно снижен порог для approve
@@ -88,7 +98,10 @@ http_client: Optional[httpx.AsyncClient] = None
 async def lifespan(app: FastAPI):
     """Lifecycle manager"""
     global http_client
-    http_client = httpx.AsyncClient(timeout=httpx.Timeout(LLM_TIMEOUT))
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(LLM_TIMEOUT),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+    )
     
     logger.info("Code Reviewer Agent started")
     yield
@@ -111,34 +124,43 @@ app = FastAPI(
 # PROMETHEUS MIDDLEWARE
 # ============================================================================
 
+@lru_cache(maxsize=256)
+def bind_request_metrics(method: str, endpoint: str) -> Tuple[Gauge, Histogram]:
+    """Дочерние метрики, привязанные к (method, endpoint)"""
+    return (
+        AGENT_ACTIVE_REQUESTS.labels(method=method, endpoint=endpoint),
+        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(method=method, endpoint=endpoint)
+    )
+
+
+@lru_cache(maxsize=256)
+def bind_requests_total(method: str, endpoint: str, status: str) -> Counter:
+    """Счётчик запросов, привязанный к (method, endpoint, status)"""
+    return AGENT_REQUESTS_TOTAL.labels(method=method, endpoint=endpoint, status=status)
+
+
 @app.middleware("http")
 async def prometheus_middleware(request, call_next):
     """Middleware для отслеживания HTTP метрик"""
-    if request.url.path in ["/health", "/metrics"]:
+    path = request.url.path
+    if path in ("/health", "/metrics"):
         return await call_next(request)
     
-    AGENT_ACTIVE_REQUESTS.labels(method=request.method, endpoint=request.url.path).inc()
-    start_time = time.time()
+    # Дочерние метрики для пары (method, endpoint) создаются один раз
+    active, response_time = bind_request_metrics(request.method, path)
+    active.inc()
+    start_time = time.perf_counter()
 
     try:
         response = await call_next(request)
-        duration = time.time() - start_time
-        status = str(response.status_code)
+        duration = time.perf_counter() - start_time
 
-        AGENT_REQUESTS_TOTAL.labels(
-            method=request.method,
-            endpoint=request.url.path,
-            status=status
-        ).inc()
-
-        AGENT_RESPONSE_TIME_SECONDS_BUCKET.labels(
-            method=request.method,
-            endpoint=request.url.path
-        ).observe(duration)
+        bind_requests_total(request.method, path, str(response.status_code)).inc()
+        response_time.observe(duration)
 
         return response
     finally:
-        AGENT_ACTIVE_REQUESTS.labels(method=request.method, endpoint=request.url.path).dec()
+        active.dec()
 
 # ============================================================================
 # LLM HELPER
@@ -209,19 +231,22 @@ async def call_llm(
     try:
         response = await http_client.post(
             f"{OPENROUTER_MCP_URL}/chat/completions",
-            json={
+            # Тело сериализуем orjson: stdlib json в httpx экранирует кириллицу
+            # промпта в \uXXXX, раздувая запрос в несколько раз
+            content=orjson.dumps({
                 "model": DEFAULT_MODEL,
                 "messages": messages,
                 "temperature": temperature,
                 "max_tokens": max_tokens
-            },
+            }),
+            headers={"Content-Type": "application/json"},
             timeout=LLM_TIMEOUT
         )
 
         duration = time.time() - start_time
 
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = orjson.loads(response.content)
             content = response_data["choices"][0]["message"]["content"]
 
             # Извлечение информации о токенах
@@ -249,7 +274,7 @@ async def call_llm(
                 "reasoning": reasoning,
                 "timestamp": datetime.now().isoformat()
             }
-            logger.info(json.dumps(response_log, ensure_ascii=False))
+            logger.info(orjson.dumps(response_log).decode())
 
             return content
         else:
@@ -262,7 +287,7 @@ async def call_llm(
                 "error_response": response.text,
                 "timestamp": datetime.now().isoformat()
             }
-            logger.error(json.dumps(error_log, ensure_ascii=False))
+            logger.error(orjson.dumps(error_log).decode())
             
             
             return ""
@@ -278,32 +303,93 @@ async def call_llm(
             "exception": str(e),
             "timestamp": datetime.now().isoformat()
         }
-        logger.error(json.dumps(exception_log, ensure_ascii=False))
+        logger.error(orjson.dumps(exception_log).decode())
         
         
         return ""
 
+def dumps_json(data: Any) -> str:
+    """Сериализует данные для вставки в промпт: JSON с отступами, без экранирования не-ASCII"""
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+
+def dump_code_for_prompt(path: Any, content: str, limit: int = QUALITY_PROMPT_CODE_LIMIT) -> str:
+    """
+    Сериализует файл для промпта в пределах limit символов, не ломая JSON:
+    длинное содержимое обрезается по границе строки и помечается truncated
+    """
+    budget = limit
+    while True:
+        snippet = content
+        truncated = len(content) > budget
+        if truncated:
+            cut = content.rfind("\n", 0, budget)
+            snippet = content[:cut if cut > 0 else budget]
+        
+        entry = {"path": path, "content": snippet}
+        if truncated:
+            entry["truncated"] = True
+        dumped = dumps_json([entry])
+        if len(dumped) <= limit or not snippet:
+            return dumped
+        
+        # Экранирование и отступы не влезли - урезаем содержимое пропорционально
+        budget = min(len(snippet) - 1, len(snippet) * limit // len(dumped))
+
+
+# JSON в markdown-блоке посреди текста
+_JSON_FENCE_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+
+
 def parse_json_response(response: str) -> Optional[Dict]:
     """Извлекает JSON из ответа LLM"""
-    try:
-        parsed = json.loads(response)
-        return parsed
-    except json.JSONDecodeError:
-        pass
+    # Типичный ответ - чистый JSON или JSON, целиком обёрнутый в ```json ... ```:
+    # снимаем ограждение срезами и разбираем один раз
+    text = response.strip()
+    if text.startswith('```'):
+        text = text[3:]
+        if text.startswith('json'):
+            text = text[4:]
+        if text.endswith('```'):
+            text = text[:-3]
+        text = text.strip()
     
+    if text.startswith(('{', '[')):
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    
+    # Запасной путь: markdown-блок посреди текста, затем от первой "{" до последней "}"
     try:
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group(1))
+        if '```' in response:
+            json_match = _JSON_FENCE_RE.search(response)
+            if json_match:
+                return orjson.loads(json_match.group(1))
         
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group())
-    except json.JSONDecodeError as e:
+        start = response.find('{')
+        end = response.rfind('}')
+        if start != -1 and end > start:
+            return orjson.loads(response[start:end + 1])
+    except orjson.JSONDecodeError as e:
         logger.error(f"JSON parse error: {e}")
     
     return None
 
+def as_str(value: Any, default: Optional[str] = None) -> Optional[str]:
+    """Строковое поле из ответа LLM: не-строки заменяются значением по умолчанию"""
+    return value if isinstance(value, str) else default
+
+
+def as_line_number(value: Any) -> Optional[int]:
+    """Номер строки из ответа LLM: int или строка из цифр, иначе None"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    # isdecimal, а не isdigit: "²" - цифра, но int() её не разберёт
+    if isinstance(value, str) and value.strip().isdecimal():
+        return int(value)
+    return None
+
 # ============================================================================
 # ARCHITECTURE COMPLIANCE CHECK (СМЯГЧЕННЫЙ)
 # ============================================================================
@@ -311,15 +397,20 @@ def parse_json_response(response: str) -> Optional[Dict]:
 async def check_architecture_compliance(
     code_file: Dict[str, Any],
     architecture: Dict[str, Any],
-    tech_stack: TechStack
+    tech_stack: TechStack,
+    architecture_json: Optional[str] = None
 ) -> Tuple[List[ArchitectureCheck], List[ReviewIssue]]:
     """
-    Проверяет соответствие кода архитектуре (мягкая проверка)
+    Проверяет соответствие кода архитектуре (мягкая проверка).
+    architecture_json - уже сериализованная architecture, общая для всех файлов ревью
     """
 
     if not architecture:
         return [], []
 
+    if architecture_json is None:
+        architecture_json = dumps_json(architecture)
+
     components = architecture.get("components", [])
     interfaces = architecture.get("interfaces", [])
     file_structure = architecture.get("file_structure", [])
@@ -328,10 +419,10 @@ async def check_architecture_compliance(
 Проверь соответствие кода архитектуре, но будь СПРАВЕДЛИВ и РАЗУМЕН.
 
 ## АРХИТЕКТУРА:
-{json.dumps(architecture, indent=2, ensure_ascii=False)}
+{architecture_json}
 
 ## КОД ДЛЯ ПРОВЕРКИ:
-{json.dumps({"path": code_file.get("path"), "content": code_file.get("content", "")[:3000]}, indent=2, ensure_ascii=False)}
+{dumps_json({"path": code_file.get("path"), "content": code_file.get("content", "")[:3000]})}
 
 ## БУДЬ МЯГКИМ:
 - Если код в целом соответствует архитектуре, это хорошо
@@ -374,7 +465,8 @@ async def check_architecture_compliance(
 ВАЖНО: Будь сдержан в оценках. Если проблема не критическая, лучше отметить её как medium или вообще не отмечать.
 """
 
-    response = await call_llm(prompt, step="architecture_compliance_check")
+    async with llm_semaphore:
+        response = await call_llm(prompt, step="architecture_compliance_check")
     parsed = parse_json_response(response)
 
     issues = []
@@ -386,23 +478,24 @@ async def check_architecture_compliance(
         issues_data = parsed.get("issues", [])
 
         for issue_data in issues_data:
-            try:
-                severity = IssueSeverity(issue_data.get("severity", "medium"))
-                # Автоматически понижаем severity на один уровень для мягкости
-                if severity == IssueSeverity.CRITICAL:
-                    severity = IssueSeverity.HIGH
-                elif severity == IssueSeverity.HIGH:
-                    severity = IssueSeverity.MEDIUM
-            except ValueError:
+            if not isinstance(issue_data, dict):
+                continue
+
+            severity = IssueSeverity.from_string(issue_data.get("severity"), IssueSeverity.MEDIUM)
+            # Автоматически понижаем severity на один уровень для мягкости
+            if severity == IssueSeverity.CRITICAL:
+                severity = IssueSeverity.HIGH
+            elif severity == IssueSeverity.HIGH:
                 severity = IssueSeverity.MEDIUM
 
-            issue = ReviewIssue(
+            # Поля приводим сами - валидацию pydantic пропускаем
+            issue = ReviewIssue.model_construct(
                 type=IssueType.ARCHITECTURE_VIOLATION,
                 severity=severity,
-                title=issue_data.get("title", "Architecture note"),
-                description=issue_data.get("description", ""),
-                file_path=issue_data.get("file_path"),
-                suggestion=issue_data.get("suggestion")
+                title=as_str(issue_data.get("title"), "Architecture note"),
+                description=as_str(issue_data.get("description"), ""),
+                file_path=as_str(issue_data.get("file_path")),
+                suggestion=as_str(issue_data.get("suggestion"))
             )
             
             issues.append(issue)
@@ -413,25 +506,17 @@ async def check_architecture_compliance(
 # CODE QUALITY CHECK (СМЯГЧЕННЫЙ)
 # ============================================================================
 
-async def check_code_quality(
-    code_file: Dict[str, Any],
-    tech_stack: TechStack
-) -> List[ReviewIssue]:
-    """
-    Проверяет качество кода (мягкая проверка)
-    """
-    
-    file_path = code_file.get("path", "unknown")
-    
-    prompt = f"""
+# Шаблон промпта проверки качества: статичная часть собирается один раз,
+# на каждый файл подставляются только стек и код
+QUALITY_PROMPT_TEMPLATE = """
 Проведи ДРУЖЕСТВЕННОЕ код-ревью. Цель - помочь, а не наказать.
 
 ## ТЕХНОЛОГИИ:
-- Язык: {tech_stack.primary_language}
-- Фреймворки: {', '.join(tech_stack.frameworks)}
+- Язык: {primary_language}
+- Фреймворки: {frameworks}
 
 ## КОД:
-{json.dumps([{"path": code_file.get("path"), "content": code_file.get("content", "")} ], indent=2, ensure_ascii=False)[:15000]}
+{code}
 
 ## БУДЬ ПОЛОЖИТЕЛЬНЫМ:
 - Сначала отметь, что сделано хорошо
@@ -482,7 +567,58 @@ async def check_code_quality(
 ПРИМЕЧАНИЕ: Будь очень осторожен с severity="critical". Используй только для реальных блокирующих проблем.
 """
 
-    response = await call_llm(prompt, step="code_quality_check", max_tokens=100000)
+
+# Типы, которые с severity=low не стоят внимания разработчика
+MINOR_ISSUE_TYPES = frozenset({IssueType.STYLE, IssueType.NAMING})
+
+# Найденные проблемы по отпечатку файла: key -> issues (LRU)
+quality_cache: "collections.OrderedDict[bytes, List[ReviewIssue]]" = collections.OrderedDict()
+
+
+def quality_cache_key(code_file: Dict[str, Any], tech_stack: TechStack) -> bytes:
+    """
+    Отпечаток всего, что попадает в промпт проверки качества
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (
+        QUALITY_PROMPT_VERSION,
+        str(code_file.get("path")),
+        code_file.get("content") or "",
+        tech_stack.primary_language,
+        ", ".join(tech_stack.frameworks),
+    ):
+        digest.update(part.encode())
+        digest.update(b"\x00")
+    return digest.digest()
+
+
+async def check_code_quality(
+    code_file: Dict[str, Any],
+    tech_stack: TechStack
+) -> List[ReviewIssue]:
+    """
+    Проверяет качество кода (мягкая проверка)
+    """
+    
+    file_path = code_file.get("path", "unknown")
+    
+    # Неизменившиеся файлы (частый случай при повторном ревью после
+    # needs_revision) не отправляем в LLM повторно
+    cache_key = quality_cache_key(code_file, tech_stack)
+    cached = quality_cache.get(cache_key)
+    if cached is not None:
+        quality_cache.move_to_end(cache_key)
+        logger.debug("Quality check cache hit for %s", file_path)
+        return list(cached)
+    
+    prompt = QUALITY_PROMPT_TEMPLATE.format(
+        primary_language=tech_stack.primary_language,
+        frameworks=', '.join(tech_stack.frameworks),
+        code=dump_code_for_prompt(code_file.get("path"), code_file.get("content") or "")
+    )
+
+    async with llm_semaphore:
+        response = await call_llm(prompt, step="code_quality_check", max_tokens=100000)
     parsed = parse_json_response(response)
     
     issues = []
@@ -491,39 +627,43 @@ async def check_code_quality(
         issues_data = parsed.get("issues", [])
         
         for issue_data in issues_data:
-            try:
-                issue_type = IssueType(issue_data.get("type", "maintainability"))
-            except ValueError:
-                issue_type = IssueType.MAINTAINABILITY
+            if not isinstance(issue_data, dict):
+                continue
             
-            try:
-                severity = IssueSeverity(issue_data.get("severity", "low"))
-                # Автоматически понижаем severity для мягкости
-                if severity == IssueSeverity.CRITICAL:
-                    severity = IssueSeverity.HIGH
-            except ValueError:
-                severity = IssueSeverity.LOW
+            issue_type = IssueType.from_string(issue_data.get("type"), IssueType.MAINTAINABILITY)
+            
+            severity = IssueSeverity.from_string(issue_data.get("severity"), IssueSeverity.LOW)
+            # Автоматически понижаем severity для мягкости
+            if severity == IssueSeverity.CRITICAL:
+                severity = IssueSeverity.HIGH
             
             # Пропускаем очень мелкие issues
-            if severity == IssueSeverity.LOW and issue_type in [IssueType.STYLE, IssueType.NAMING]:
+            if severity is IssueSeverity.LOW and issue_type in MINOR_ISSUE_TYPES:
                 continue
             
-            issue = ReviewIssue(
+            # Поля приводим сами - валидацию pydantic пропускаем
+            issue = ReviewIssue.model_construct(
                 type=issue_type,
                 severity=severity,
-                title=issue_data.get("title", "Suggestion"),
-                description=issue_data.get("description", ""),
-                file_path=issue_data.get("file_path"),
-                line_number=issue_data.get("line_number"),
-                code_snippet=issue_data.get("code_snippet"),
-                suggestion=issue_data.get("suggestion"),
-                suggested_code=issue_data.get("suggested_code"),
-                effort_to_fix=issue_data.get("effort_to_fix", "low")
+                title=as_str(issue_data.get("title"), "Suggestion"),
+                description=as_str(issue_data.get("description"), ""),
+                file_path=as_str(issue_data.get("file_path")),
+                line_number=as_line_number(issue_data.get("line_number")),
+                code_snippet=as_str(issue_data.get("code_snippet")),
+                suggestion=as_str(issue_data.get("suggestion")),
+                suggested_code=as_str(issue_data.get("suggested_code")),
+                effort_to_fix=as_str(issue_data.get("effort_to_fix"), "low")
             )
             
             issues.append(issue)
+        
+        # Кэшируем только разобранный ответ, чтобы сбой LLM не закрепился.
+        # ReviewIssue неизменяемы, поэтому делить их между ответами безопасно
+        quality_cache[cache_key] = issues
+        if len(quality_cache) > QUALITY_CACHE_SIZE:
+            quality_cache.popitem(last=False)
     
-    return issues
+    return list(issues)
 
 # ============================================================================
 # PARALLEL FILE PROCESSING
@@ -532,31 +672,50 @@ async def check_code_quality(
 async def process_file_parallel(
     code_file: Dict[str, Any],
     architecture: Dict[str, Any],
-    tech_stack: TechStack
+    tech_stack: TechStack,
+    architecture_json: Optional[str] = None
 ) -> Tuple[List[ArchitectureCheck], List[ReviewIssue]]:
     """
     Параллельно обрабатывает один файл
     """
     file_path = code_file.get('path')
     
-    async with llm_semaphore:
-        try:
-            # 1. Проверка соответствия архитектуре
-            arch_checks, arch_issues = await check_architecture_compliance(
-                code_file, architecture, tech_stack
-            )
-            
-            # 2. Проверка качества кода
-            quality_issues = await check_code_quality(code_file, tech_stack)
-            
-            # Объединяем все проблемы
-            all_issues = arch_issues + quality_issues
-            
-            return arch_checks, all_issues
-        
-        except Exception as e:
-            logger.error(f"Error processing {file_path}: {e}")
+    try:
+        # Пустой файл проверять нечего - не тратим на него LLM-запросы
+        if not (code_file.get("content") or "").strip():
+            logger.debug("Skipping empty file %s", file_path)
             return [], []
+        
+        # Проверки архитектуры и качества независимы - запускаем одновременно.
+        # Слот семафора LLM берётся только на сам запрос к модели, поэтому
+        # попадания в кэш не ждут в очереди за медленными вызовами
+        arch_result, quality_result = await asyncio.gather(
+            check_architecture_compliance(code_file, architecture, tech_stack, architecture_json),
+            check_code_quality(code_file, tech_stack),
+            return_exceptions=True
+        )
+
+        # Падение одной проверки не должно обнулять результат другой
+        if isinstance(arch_result, BaseException):
+            logger.error(f"Architecture check failed for {file_path}: {arch_result}")
+            arch_checks, arch_issues = [], []
+        else:
+            arch_checks, arch_issues = arch_result
+
+        if isinstance(quality_result, BaseException):
+            logger.error(f"Quality check failed for {file_path}: {quality_result}")
+            quality_issues = []
+        else:
+            quality_issues = quality_result
+
+        # Объединяем все проблемы
+        all_issues = arch_issues + quality_issues
+        
+        return arch_checks, all_issues
+    
+    except Exception as e:
+        logger.error(f"Error processing {file_path}: {e}")
+        return [], []
 
 # ============================================================================
 # DECISION MAKING (СМЯГЧЕННЫЙ)
@@ -567,17 +726,22 @@ def make_review_decision(issues: List[ReviewIssue]) -> Tuple[ReviewDecision, boo
     Принимает решение на основе найденных проблем (мягкая логика)
     """
     
-    critical_count = sum(1 for i in issues if i.severity == IssueSeverity.CRITICAL)
-    high_count = sum(1 for i in issues if i.severity == IssueSeverity.HIGH)
-    
-    logger.info(f"Review decision: {critical_count} critical, {high_count} high issues")
-    
+    # Один проход: для решения важны только critical и high, остальные
+    # severity не считаем. ID критических проблем - блокирующие
+    # Члены Enum - синглтоны: в горячем цикле сравниваем через is с локальными именами
+    critical, high = IssueSeverity.CRITICAL, IssueSeverity.HIGH
     blocking_ids = []
-    
-    # Собираем ID только критических проблем как блокирующие
+    high_count = 0
     for issue in issues:
-        if issue.severity == IssueSeverity.CRITICAL:
+        severity = issue.severity
+        if severity is critical:
             blocking_ids.append(issue.id)
+        elif severity is high:
+            high_count += 1
+    
+    critical_count = len(blocking_ids)
+    
+    logger.info(f"Review decision: {critical_count} critical, {high_count} high issues")
     
     # Мягкая логика принятия решений
     if critical_count > QUALITY_THRESHOLDS["max_critical_for_approve"]:
@@ -616,16 +780,17 @@ def calculate_quality_score(issues: List[ReviewIssue], total_files: int) -> floa
             IssueSeverity.LOW: 0.01,       # Практически игнорируем
         }
         
-        # Считаем взвешенную сумму проблем с безопасным доступом
+        # Считаем взвешенную сумму проблем: один проход по списку,
+        # дальше умножаем вес на количество для каждой severity
         total_weight = 0
         try:
-            for issue in issues:
-                if hasattr(issue, 'severity') and issue.severity:
-                    weight = severity_weights.get(issue.severity, 0.1)
-                    total_weight += weight
+            severity_counts = collections.Counter(getattr(issue, 'severity', None) for issue in issues)
+            for severity, count in severity_counts.items():
+                if severity:
+                    total_weight += severity_weights.get(severity, 0.1) * count
                 else:
-                    logger.debug("Issue without severity, using default weight")
-                    total_weight += 0.1
+                    logger.debug("Issues without severity, using default weight")
+                    total_weight += 0.1 * count
         except Exception as e:
             logger.error(f"Error calculating total weight: {e}")
             total_weight = len(issues) * 0.1  # Используем минимальный вес
@@ -637,7 +802,7 @@ def calculate_quality_score(issues: List[ReviewIssue], total_files: int) -> floa
         score = max(0, 10 - (issues_per_file * 1))
         
         final_score = round(score, 1)
-        logger.debug(f"Quality score calculated: {final_score} (issues: {len(issues)}, files: {total_files}, weight: {total_weight})")
+        logger.debug("Quality score calculated: %s (issues: %d, files: %d, weight: %s)", final_score, len(issues), total_files, total_weight)
         
         return final_score
         
@@ -664,10 +829,13 @@ async def perform_code_review(
     
     logger.info(f"Starting parallel processing of {len(code_files)} files")
     
+    # Архитектура одна на все файлы - сериализуем для промптов один раз
+    architecture_json = dumps_json(architecture) if architecture else None
+    
     # Создаем задачи для параллельной обработки файлов
     tasks = []
     for code_file in code_files:
-        task = process_file_parallel(code_file, architecture, tech_stack)
+        task = process_file_parallel(code_file, architecture, tech_stack, architecture_json)
         tasks.append(task)
     
     # Запускаем параллельную обработку
@@ -688,39 +856,47 @@ async def perform_code_review(
     # Вычисляем оценку
     quality_score = calculate_quality_score(all_issues, len(code_files))
     
-    # Создаем метрики
-    metrics = ReviewMetrics(
-        total_files=len(code_files),
-        total_lines=sum(f.get("content", "").count('\n') + 1 for f in code_files),
-        total_issues=len(all_issues),
-        critical_issues=sum(1 for i in all_issues if i.severity == IssueSeverity.CRITICAL),
-        high_issues=sum(1 for i in all_issues if i.severity == IssueSeverity.HIGH),
-        medium_issues=sum(1 for i in all_issues if i.severity == IssueSeverity.MEDIUM),
-        low_issues=sum(1 for i in all_issues if i.severity == IssueSeverity.LOW),
-        bugs=sum(1 for i in all_issues if i.type == IssueType.BUG),
-        performance_issues=sum(1 for i in all_issues if i.type == IssueType.PERFORMANCE),
-        overall_quality_score=quality_score,
-        maintainability_score=10.0 - (len([i for i in all_issues if i.severity in [IssueSeverity.CRITICAL, IssueSeverity.HIGH]]) * 0.5)
-    )
+    # Раскладываем проблемы по файлам один раз, чтобы не сканировать
+    # весь список для каждого файла
+    issues_by_file = collections.defaultdict(list)
+    for issue in all_issues:
+        issues_by_file[issue.file_path].append(issue)
     
     # Создаём сводки по файлам
+    critical, high = IssueSeverity.CRITICAL, IssueSeverity.HIGH
     file_summaries = []
     for file_data in code_files:
         path = file_data.get("path", "unknown")
-        file_issues = [i for i in all_issues if i.file_path == path]
+        file_issues = issues_by_file.get(path, [])
+        
+        critical_in_file = high_in_file = 0
+        for issue in file_issues:
+            severity = issue.severity
+            if severity is critical:
+                critical_in_file += 1
+            elif severity is high:
+                high_in_file += 1
         
         summary = FileSummary(
             file_path=path,
             language=file_data.get("language", "unknown"),
             lines_of_code=file_data.get("content", "").count('\n') + 1,
             issues_count=len(file_issues),
-            critical_count=sum(1 for i in file_issues if i.severity == IssueSeverity.CRITICAL),
-            high_count=sum(1 for i in file_issues if i.severity == IssueSeverity.HIGH),
+            critical_count=critical_in_file,
+            high_count=high_in_file,
             quality_score=10.0 - (len(file_issues) * 0.2),
             recommendations=[i.suggestion for i in file_issues[:3] if i.suggestion]
         )
         file_summaries.append(summary)
     
+    # Создаем метрики; строки уже посчитаны в сводках по файлам
+    metrics = ReviewMetrics.from_issues(
+        all_issues,
+        total_files=len(code_files),
+        total_lines=sum(file_summary.lines_of_code for file_summary in file_summaries),
+        overall_quality_score=quality_score
+    )
+    
     # Архитектурное соответствие
     architecture_compliance = ArchitectureCompliance(
         overall_compliant=len([c for c in all_architecture_checks if not c.compliant]) == 0,
@@ -735,18 +911,21 @@ async def perform_code_review(
     critical_count = metrics.critical_issues
     high_count = metrics.high_issues
     
-    if decision == ReviewDecision.APPROVED:
-        summary = f"✅ Код одобрен\n\n"
-    else:
-        summary = f"⚠️ Требуется доработка\n\n"
-    
-    summary += f"Оценка: {quality_score}/10\n"
-    summary += f"Проблемы: {critical_count} критических, {high_count} высоких\n\n"
+    summary_parts = [
+        "✅ Код одобрен\n\n" if decision == ReviewDecision.APPROVED else "⚠️ Требуется доработка\n\n",
+        f"Оценка: {quality_score}/10\n",
+        f"Проблемы: {critical_count} критических, {high_count} высоких\n\n",
+    ]
     
     if critical_count > 0:
-        summary += "Критические проблемы:\n"
-        for issue in [i for i in all_issues if i.severity == IssueSeverity.CRITICAL][:3]:
-            summary += f"- {issue.title}\n"
+        summary_parts.append("Критические проблемы:\n")
+        # Нужны только первые три - не фильтруем весь список
+        first_critical = itertools.islice(
+            (i for i in all_issues if i.severity is critical), 3
+        )
+        summary_parts.extend(f"- {issue.title}\n" for issue in first_critical)
+    
+    summary = "".join(summary_parts)
     
     suggestions = []
     if critical_count > 0:
@@ -758,8 +937,10 @@ async def perform_code_review(
     
     # Обновляем метрики Prometheus
     REVIEWS_TOTAL.labels(decision=decision.value).inc()
-    for issue in all_issues:
-        ISSUES_FOUND.labels(severity=issue.severity.value, type=issue.type.value).inc()
+    # Различных пар (severity, type) немного - инкрементируем пачкой
+    issue_label_counts = collections.Counter((issue.severity.value, issue.type.value) for issue in all_issues)
+    for (severity, issue_type), count in issue_label_counts.items():
+        ISSUES_FOUND.labels(severity=severity, type=issue_type).inc(count)
     
     return ReviewResult(
         decision=decision,
@@ -800,10 +981,10 @@ async def process_code_review(request: CodeReviewRequest):
         try:
             if "code" in data and "files" in data["code"]:
                 code_files = data["code"]["files"]
-                logger.debug(f"[{task_id[:8]}] Found {len(code_files)} files in data.code.files")
+                logger.debug("[%s] Found %d files in data.code.files", task_id[:8], len(code_files))
             elif "files" in data:
                 code_files = data["files"]
-                logger.debug(f"[{task_id[:8]}] Found {len(code_files)} files in data.files")
+                logger.debug("[%s] Found %d files in data.files", task_id[:8], len(code_files))
             else:
                 logger.warning(f"[{task_id[:8]}] No code files found in request data")
                 raise HTTPException(status_code=400, detail="No code files provided")
@@ -843,7 +1024,7 @@ async def process_code_review(request: CodeReviewRequest):
                 tech_stack = TechStack(**tech_stack_data)
             else:
                 tech_stack = TechStack()
-                logger.debug(f"[{task_id[:8]}] Using default TechStack")
+                logger.debug("[%s] Using default TechStack", task_id[:8])
             
             repo_context = data.get("repo_context", {})
         except Exception as e:
@@ -921,7 +1102,7 @@ async def review_repo(request: Dict[str, Any]):
         if not target_folder.strip():
             logger.error(f"[{task_id}] target_folder cannot be empty")
             raise HTTPException(status_code=400, detail="target_folder cannot be empty")
-        logger.debug(f"[{task_id}] Using target_folder: {target_folder}")
+        logger.debug("[%s] Using target_folder: %s", task_id, target_folder)
     
     try:
         # Извлекаем и валидируем входные данные
@@ -938,7 +1119,7 @@ async def review_repo(request: Dict[str, Any]):
                 tech_stack = TechStack(**tech_stack_data)
             else:
                 tech_stack = TechStack()
-                logger.debug(f"[{task_id}] Using default TechStack")
+                logger.debug("[%s] Using default TechStack", task_id)
         except Exception as e:
             logger.error(f"[{task_id}] Error creating TechStack: {e}")
             tech_stack = TechStack()
@@ -1125,6 +1306,9 @@ if __name__ == "__main__":
         "server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        loop="uvloop",
+        http="httptools",
+        # Перезапуск по изменениям файлов - только для локальной разработки
+        reload=os.getenv("ENV") == "dev",
         log_level="info"
     )
\ No newline at end of file